@@ -4,15 +4,32 @@
 #
 # These prerequisites are currently installed in an Anaconda environment named 'aspen_query'
 #
-import pymssql
+# pymssql and the connection settings in aspendb_config are only imported when
+# a connection is made, so the models can be imported without either.
+#
 import sys
 
-# Connection information for MSQL version of Aspen Database
-from aspendb_config import server, user, password, database
+
+def connection_settings(server=None, user=None, password=None, database=None):
+    """ Return a dict of the connection settings, taking any not given from
+        aspendb_config, the connection information for the MSQL version of
+        the Aspen Database.
+    """
+    import aspendb_config
+    settings = {'server': server, 'user': user, 'password': password,
+                'database': database}
+    for k, v in settings.items():
+        if v is None:
+            settings[k] = getattr(aspendb_config, k)
+    return settings
 
 
-def connect(server=server, user=user, password=password, database=database, as_dict=True):
-    return pymssql.connect(server, user, password, database, as_dict=as_dict)
+def connect(server=None, user=None, password=None, database=None, as_dict=True):
+    import pymssql
+    settings = connection_settings(server, user, password, database)
+    return pymssql.connect(settings['server'], settings['user'],
+                           settings['password'], settings['database'],
+                           as_dict=as_dict)
 
 
 def simple_connect_test(argv=None):
@@ -36,10 +53,20 @@ def simple_connect_test(argv=None):
 import sqlalchemy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import relationship
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import contains_eager, joinedload, subqueryload
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError:
+    # SQLAlchemy < 1.2 has no "select IN" loading
+    selectinload = subqueryload
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import Column, Integer, Float, String, Date, DateTime, Text, \
         ForeignKey, ForeignKeyConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
+
+import query_stats
+import rawfetch
+
 Base = declarative_base()
 class Location(Base):
     __tablename__ = 'TLOCATION'
@@ -156,8 +183,9 @@ class SettingInfo(Base):
     settings = relationship('Setting', back_populates='settinginfo')
 
 
-class RTU_Equipment(Base):
-    __tablename__ = 'TUSERDEF2'
+class UserDefDevice(Base):
+    """ Common columns of the user-defined device tables, TUSERDEFn. """
+    __abstract__ = True
     id = Column(Integer, primary_key=True)
     protecting = Column('s07', String)
     district_num = Column('s01', String)
@@ -172,19 +200,17 @@ class RTU_Equipment(Base):
     ieee_num = Column('s05', String)
     owner = Column('s19', String)
     functional_location = Column('s20', String)
-    locationid = Column(String, ForeignKey('TLOCATION.id'))
-    location = relationship('Location', back_populates='rtu_equipment')
-    requests = relationship('RTURequest', order_by='RTURequest.request_date',
-                            back_populates='rtu_equipment')
 
-
-Location.rtu_equipment = relationship('RTU_Equipment',
-                                      order_by=RTU_Equipment.id,
-                                      back_populates='location')
+    @declared_attr
+    def locationid(cls):
+        return Column(String, ForeignKey('TLOCATION.id'))
 
 
-class RTURequest(Base):
-    __tablename__ = 'TUSERDEF2REQUEST'
+class UserDefRequest(Base):
+    """ Common columns of the user-defined device request tables,
+        TUSERDEFnREQUEST.
+    """
+    __abstract__ = True
     id = Column(Integer, primary_key=True)
     requestor = Column('s01', String)
     setting_type = Column('s02', String)
@@ -195,9 +221,34 @@ class RTURequest(Base):
     sign = Column(String)
     dlastsigned = Column(DateTime)
     dlastchanged = Column(DateTime)
-    deviceid = Column(String, ForeignKey('TUSERDEF2.id'))
+
+    @declared_attr
+    def deviceid(cls):
+        device_table = cls.__tablename__[:-len('REQUEST')]
+        return Column(String, ForeignKey(device_table + '.id'))
+
+
+class RTU_Equipment(UserDefDevice):
+    __tablename__ = 'TUSERDEF2'
+    location = relationship('Location', back_populates='rtu_equipment')
+    requests = relationship('RTURequest', order_by='RTURequest.request_date',
+                            back_populates='rtu_equipment')
+
+
+Location.rtu_equipment = relationship('RTU_Equipment',
+                                      order_by=RTU_Equipment.id,
+                                      back_populates='location')
+
+
+class RTURequest(UserDefRequest):
+    __tablename__ = 'TUSERDEF2REQUEST'
     rtu_equipment = relationship('RTU_Equipment', back_populates='requests')
+    # TDEVSETTING1 holds the settings of every TUSERDEFn table
     settings = relationship('RTUSetting',
+                            primaryjoin='and_(RTURequest.id == '
+                                        'RTUSetting.requestid, '
+                                        'RTUSetting.userdef_table == '
+                                        '"TUSERDEF2")',
                             order_by='(RTUSetting.groupname, '
                                      'RTUSetting.rownumber)',
                             back_populates='request')
@@ -206,8 +257,9 @@ class RTURequest(Base):
 class RTUSetting(Base):
     __tablename__ = 'TDEVSETTING1'
     __table_args__ = (
-    ForeignKeyConstraint(['template', 'groupname', 'rownumber'],
-                         ['TDEVSETTYPE1.template', 'TDEVSETTYPE1.groupname',
+    ForeignKeyConstraint(['template', 'device', 'groupname', 'rownumber'],
+                         ['TDEVSETTYPE1.template', 'TDEVSETTYPE1.device',
+                          'TDEVSETTYPE1.groupname',
                           'TDEVSETTYPE1.rownumber']),)
     __mapper_args__ = {
         'polymorphic_on': 'userdef_table',
@@ -246,15 +298,320 @@ class RTUSettingInfo(Base):
     comments = Column(String)
     settings = relationship('RTUSetting',
                             back_populates='settinginfo')
-    
 
-def get_orm_sessionmaker(server=server, user=user, password=password, database=database):
-    engine = sqlalchemy.create_engine('mssql+pymssql://%(user)s:%(password)s@%(server)s/%(database)s?charset=utf8' %
-                                            {'user': user, 'password': password, 'server': server, 'database': database},
-                                       echo=False)
+
+# User-defined device tables. Each TUSERDEFn table has the UserDefDevice
+# columns and a TUSERDEFnREQUEST table of requests, and their settings are in
+# TDEVSETTING1 / TDEVSETTYPE1 with device = 'TUSERDEFn'. Table name:
+# (device, request, setting, setting info) classes. TUSERDEF2 is mapped
+# above; register_userdef() maps others and register_userdef_tables() maps
+# every one found in the database.
+userdef_tables = {'TUSERDEF2': (RTU_Equipment, RTURequest, RTUSetting,
+                                RTUSettingInfo)}
+
+
+def register_userdef(n):
+    """ Map user-defined device table TUSERDEFn, its requests and settings as
+        classes UserDef<n>, UserDef<n>Request, UserDef<n>Setting and
+        UserDef<n>SettingInfo, and return them.
+        Devices have location and requests relationships, requests have
+        device and settings relationships and settings have a request
+        relationship. The setting classes are RTUSetting / RTUSettingInfo
+        subclasses, so queries of those load every device table's settings.
+    """
+    table = 'TUSERDEF%d' % n
+    try:
+        return userdef_tables[table]
+    except KeyError:
+        pass
+    name = str('UserDef%d' % n)
+    device = type(name, (UserDefDevice,), {'__tablename__': table})
+    request = type(name + str('Request'), (UserDefRequest,),
+                   {'__tablename__': table + 'REQUEST'})
+    # The request relationship replaces the one inherited from RTUSetting,
+    # which is to TUSERDEF2REQUEST
+    setting = type(name + str('Setting'), (RTUSetting,), {
+        '__mapper_args__': {'polymorphic_identity': table},
+        'request': relationship(
+            request,
+            primaryjoin=lambda: sqlalchemy.and_(
+                sqlalchemy.orm.foreign(RTUSetting.requestid) == request.id,
+                RTUSetting.userdef_table == table),
+            viewonly=True)})
+    setting_info = type(name + str('SettingInfo'), (RTUSettingInfo,),
+                        {'__mapper_args__': {'polymorphic_identity': table}})
+    device.location = relationship(Location)
+    device.requests = relationship(request, order_by=request.request_date,
+                                   back_populates='device')
+    request.device = relationship(device, back_populates='requests')
+    request.settings = relationship(
+        setting,
+        primaryjoin=sqlalchemy.orm.foreign(setting.requestid) == request.id,
+        order_by=(setting.groupname, setting.rownumber),
+        viewonly=True)
+    userdef_tables[table] = (device, request, setting, setting_info)
+    return userdef_tables[table]
+
+
+def register_userdef_tables(session):
+    """ Register every TUSERDEFn table with a TUSERDEFnREQUEST table in the
+        database. Returns the sorted list of table names registered.
+    """
+    names = set(n.upper() for n in
+                sqlalchemy.inspect(session.get_bind()).get_table_names())
+    for name in names:
+        if name.startswith('TUSERDEF') and name[8:].isdigit() \
+                and name + 'REQUEST' in names:
+            register_userdef(int(name[8:]))
+    return sorted(userdef_tables)
+
+
+def devices_query(session, locationid=None, relays=True):
+    """ Query for every device of every user-defined device table, and of
+        TRELAY if relays is set, as one UNION ALL. Rows have device_table,
+        id, locationid, relaytype, device_num, sap_eq_num, district_num,
+        style_num, serial_num, protecting, owner and functional_location.
+        locationid optionally restricts the query to one location.
+    """
+    classes = [('TRELAY', Relay)] if relays else []
+    classes.extend((table, userdef_tables[table][0])
+                   for table in sorted(userdef_tables))
+    queries = []
+    for table, cls in classes:
+        q = session.query(sqlalchemy.literal(table).label('device_table'),
+                          cls.id.label('id'), cls.locationid, cls.relaytype,
+                          cls.device_num, cls.sap_eq_num, cls.district_num,
+                          cls.style_num, cls.serial_num, cls.protecting,
+                          cls.owner, cls.functional_location)
+        if locationid is not None:
+            q = q.filter(cls.locationid == locationid)
+        queries.append(q)
+    return queries[0].union_all(*queries[1:])
+
+
+def userdef_settings_query(session, settingname=None, setting=None,
+                           locationid=None, status='IN SERVICE',
+                           latest=True):
+    """ Query for the settings of every user-defined device table as one
+        UNION ALL. Rows have device_table, deviceid, locationid, requestid,
+        request_date, status, devicetype, groupname, rownumber, settingname
+        and setting. settingname and setting may use SQL LIKE wildcards.
+        Only requests with the given status are included (status=None
+        includes every request), and if latest is set only the latest of
+        those per device.
+    """
+    s = RTUSetting.__table__
+    info = RTUSettingInfo.__table__
+    queries = []
+    for table in sorted(userdef_tables):
+        device, request = userdef_tables[table][:2]
+        q = session.query(sqlalchemy.literal(table).label('device_table'),
+                          device.id.label('deviceid'), device.locationid,
+                          request.id.label('requestid'),
+                          request.request_date, request.status,
+                          s.c.template.label('devicetype'), s.c.groupname,
+                          s.c.rownumber, info.c.settingname, s.c.setting) \
+            .select_from(s) \
+            .join(request, request.id == s.c.requestid) \
+            .join(device, device.id == request.deviceid) \
+            .outerjoin(info, sqlalchemy.and_(
+                info.c.template == s.c.template,
+                info.c.device == s.c.device,
+                info.c.groupname == s.c.groupname,
+                info.c.rownumber == s.c.rownumber)) \
+            .filter(s.c.device == table)
+        if latest:
+            ranked = latest_requests(session, status, request) \
+                .with_entities(request.id).subquery()
+            q = q.filter(request.id.in_(sqlalchemy.select([ranked.c.id])))
+        elif status is not None:
+            q = q.filter(request.status == status)
+        if settingname is not None:
+            q = q.filter(info.c.settingname.like(settingname))
+        if setting is not None:
+            q = q.filter(s.c.setting.like(setting))
+        if locationid is not None:
+            q = q.filter(device.locationid == locationid)
+        queries.append(q)
+    return queries[0].union_all(*queries[1:])
+
+
+def latest_requests(session, status='IN SERVICE', entity=Request,
+                    device_ids=None):
+    """ Query for the latest Request of each relay, by request date, using a
+        window function. Only requests with the given status are considered;
+        status=None considers every request.
+        entity can be RTURequest, or another user-defined device request
+        class, to get the latest request per device.
+        device_ids optionally restricts the query to some relays/devices,
+        given as ints or strings.
+    """
+    device_id = entity.relayid if entity is Request else entity.deviceid
+    rank = sqlalchemy.func.row_number().over(
+        partition_by=device_id,
+        order_by=(entity.request_date.desc(), entity.id.desc()))
+    ranked = session.query(entity.id.label('id'), rank.label('rank'))
+    if status is not None:
+        ranked = ranked.filter(entity.status == status)
+    if device_ids is not None:
+        # relayid/deviceid are varchar columns. Bind strings so the server
+        # compares them as stored and can use the index, rather than
+        # converting every row's value to a number.
+        ranked = ranked.filter(device_id.in_([str(i) for i in device_ids]))
+    ranked = ranked.subquery()
+    return session.query(entity) \
+        .join(ranked, entity.id == ranked.c.id) \
+        .filter(ranked.c.rank == 1)
+
+
+def current_settings_query(session, relay_ids=None):
+    """ Query for the settings of each relay's latest in-service request,
+        one row per relay and setting, in a single windowed query.
+        Rows have relayid, locationid, relaytype, requestid, request_date,
+        groupname, rownumber, settingname and setting.
+    """
+    return latest_requests(session, device_ids=relay_ids) \
+        .join(Request.relay) \
+        .join(Request.settings) \
+        .outerjoin(Setting.settinginfo) \
+        .with_entities(Relay.id.label('relayid'),
+                       Relay.locationid,
+                       Setting.relaytype,
+                       Request.id.label('requestid'),
+                       Request.request_date,
+                       Setting.groupname,
+                       Setting.rownumber,
+                       SettingInfo.settingname,
+                       Setting.setting)
+
+
+def setting_value_counts(session, relaytype=None, settingname=None):
+    """ Query for the number of relays using each value of each setting in
+        their latest in-service request, counted by the database. Rows have
+        relaytype, groupname, rownumber, settingname, setting and relays.
+        relaytype and settingname may use SQL LIKE wildcards.
+    """
+    query = latest_requests(session) \
+        .join(Request.settings) \
+        .outerjoin(Setting.settinginfo)
+    if relaytype is not None:
+        query = query.filter(Setting.relaytype.like(relaytype))
+    if settingname is not None:
+        query = query.filter(SettingInfo.settingname.like(settingname))
+    group = (Setting.relaytype, Setting.groupname, Setting.rownumber,
+             SettingInfo.settingname, Setting.setting)
+    return query.with_entities(*group + (
+        sqlalchemy.func.count(sqlalchemy.distinct(Request.relayid))
+        .label('relays'),)).group_by(*group)
+
+
+def _request_latest_in_service(query):
+    """ Restrict a Request query to the latest in-service request per relay
+        with the relay, its location and the request's settings loaded.
+        Filter on Relay or Location columns to select relays.
+    """
+    ranked = latest_requests(query.session).subquery()
+    return query.join(ranked, Request.id == ranked.c.id) \
+        .join(Request.relay) \
+        .join(Relay.location) \
+        .options(contains_eager(Request.relay)
+                 .contains_eager(Relay.location),
+                 selectinload(Request.settings))
+
+
+# Named loading profiles for the report access patterns. Each one takes a
+# query of the entity in its name and returns it with the loader options
+# that load everything the report walks in a fixed number of queries, instead
+# of one lazy load per object. Apply with with_profile(query, name).
+load_profiles = {
+    'location-with-devices': lambda q: q.options(
+        selectinload(Location.relays),
+        selectinload(Location.rtu_equipment)),
+    'relay-with-location': lambda q: q.options(
+        joinedload(Relay.location)),
+    'relay-with-requests': lambda q: q.options(
+        joinedload(Relay.location),
+        selectinload(Relay.requests)),
+    'relay-with-settings': lambda q: q.options(
+        joinedload(Relay.location),
+        selectinload(Relay.requests).selectinload(Request.settings)),
+    'request-latest-in-service': _request_latest_in_service,
+    'request-with-relay': lambda q: q.options(
+        joinedload(Request.relay).joinedload(Relay.location)),
+    'request-with-settings': lambda q: q.options(
+        joinedload(Request.relay).joinedload(Relay.location),
+        selectinload(Request.settings)),
+    'setting-with-request': lambda q: q.options(
+        joinedload(Setting.request).joinedload(Request.relay)
+        .joinedload(Relay.location)),
+    'rtu-with-settings': lambda q: q.options(
+        joinedload(RTU_Equipment.location),
+        selectinload(RTU_Equipment.requests)
+        .selectinload(RTURequest.settings)),
+    'rturequest-with-settings': lambda q: q.options(
+        joinedload(RTURequest.rtu_equipment)
+        .joinedload(RTU_Equipment.location),
+        selectinload(RTURequest.settings)),
+}
+
+
+def with_profile(query, name):
+    """ Apply the named loading profile from load_profiles to query. """
+    return load_profiles[name](query)
+
+
+
+# SQLAlchemy URL overriding the MSSQL connection settings, e.g. a synthetic
+# SQLite database built by synthdb.py for benchmarking. None uses the
+# connection information from aspendb_config.
+engine_url = None
+
+
+def get_orm_sessionmaker(server=None, user=None, password=None, database=None):
+    if engine_url is not None:
+        engine = sqlalchemy.create_engine(engine_url, echo=False)
+    else:
+        engine = sqlalchemy.create_engine('mssql+pymssql://%(user)s:%(password)s@%(server)s/%(database)s?charset=utf8' %
+                                                connection_settings(server, user, password, database),
+                                           echo=False)
+    query_stats.instrument_from_env(engine, 'aspendb')
     return sessionmaker(bind=engine)
 
 
+def raw_connect():
+    """ Return a raw DBAPI connection producing tuple rows: pymssql with
+        as_dict=False, or the engine_url database when that is set.
+    """
+    if engine_url is not None:
+        engine = sqlalchemy.create_engine(engine_url,
+                                          poolclass=sqlalchemy.pool.NullPool)
+        return engine.raw_connection()
+    return connect(as_dict=False)
+
+
+def fetch_rows(sql, params=None, batch=rawfetch.BATCH):
+    """ Run sql on a new raw connection and return a rawfetch.Result of
+        tuple rows fetched batch rows at a time. Much cheaper than dict rows
+        or the ORM for bulk reads.
+    """
+    con = raw_connect()
+    try:
+        return rawfetch.fetch_rows(con, sql, params, batch)
+    finally:
+        con.close()
+
+
+def fetch_columns(sql, params=None, batch=rawfetch.BATCH):
+    """ Run sql on a new raw connection and return an OrderedDict of column
+        name: list of values.
+    """
+    con = raw_connect()
+    try:
+        return rawfetch.fetch_columns(con, sql, params, batch)
+    finally:
+        con.close()
+
+
 def _abort_ro(*args,**kwargs):
     ''' Monkey patch function for session flush to make it read-only.
         Based on code at https://writeonly.wordpress.com/2009/07/16/simple-read-only-sqlalchemy-sessions/
@@ -262,7 +619,7 @@ def _abort_ro(*args,**kwargs):
     #print('Error writing. Database opened in read-only mode.')
     return 
     
-def get_orm_session(server=server, user=user, password=password, database=database, readonly=True):
+def get_orm_session(server=None, user=None, password=None, database=None, readonly=True):
     Session = get_orm_sessionmaker(server=server, user=user, password=password, database=database)
     session = Session()
     if readonly:
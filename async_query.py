@@ -0,0 +1,163 @@
+# asyncio interface to the aspendb and eqdb ORM sessions (Python 3 only).
+#
+# pymssql and cx_Oracle are blocking drivers, so queries run on a bounded
+# thread pool, each call in its own read-only session. The limit sets how
+# many queries are in flight at once, and so how many database connections
+# are used.
+#
+# Query functions take a session as their first argument and run in a worker
+# thread. The session is closed when the function returns, so load
+# everything the caller needs inside the function (see the loading profiles
+# in aspendb.load_profiles) rather than relying on lazy loads afterwards.
+#
+# Example:
+#   async def main():
+#       async with AsyncDatabase.sap(limit=8) as sap:
+#           found = await sap_equipment_for_locations(sap, sap_fls)
+#       async with AsyncDatabase.aspen() as aspen:
+#           async for row in aspen.stream(
+#                   lambda s: s.query(aspendb.Setting), batch=5000):
+#               ...
+#   asyncio.run(main())
+import asyncio
+import functools
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import aspendb
+import eqdb
+
+
+class AsyncDatabase(object):
+    def __init__(self, sessionmaker, limit=4, readonly=True):
+        self.sessionmaker = sessionmaker
+        self.limit = limit
+        self.readonly = readonly
+        self.executor = ThreadPoolExecutor(max_workers=limit)
+        self._stream_slots = None
+
+    @classmethod
+    def aspen(cls, limit=4, **kwargs):
+        """ AsyncDatabase for the Aspen database. kwargs are passed to
+            aspendb.get_orm_sessionmaker().
+        """
+        return cls(aspendb.get_orm_sessionmaker(**kwargs), limit=limit)
+
+    @classmethod
+    def sap(cls, limit=4):
+        """ AsyncDatabase for the SAP equipment database. """
+        return cls(eqdb.get_orm_sessionmaker(), limit=limit)
+
+    def _new_session(self):
+        session = self.sessionmaker()
+        if self.readonly:
+            session.flush = aspendb._abort_ro
+        return session
+
+    def _call(self, fn, args, kwargs):
+        session = self._new_session()
+        try:
+            return fn(session, *args, **kwargs)
+        finally:
+            session.close()
+
+    async def run(self, fn, *args, **kwargs):
+        """ Run fn(session, *args, **kwargs) in a worker thread. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(self._call, fn, args, kwargs))
+
+    async def all(self, query_fn, *args, **kwargs):
+        """ Return query_fn(session, ...).all() """
+        return await self.run(
+            lambda session: query_fn(session, *args, **kwargs).all())
+
+    async def first(self, query_fn, *args, **kwargs):
+        """ Return query_fn(session, ...).first() """
+        return await self.run(
+            lambda session: query_fn(session, *args, **kwargs).first())
+
+    async def map(self, fn, items):
+        """ Run fn(session, item) for every item, at most limit at a time,
+            and return the results in the order of items.
+        """
+        return await asyncio.gather(*[self.run(fn, item) for item in items])
+
+    async def stream(self, query_fn, *args, **kwargs):
+        """ Asynchronously iterate over the rows of query_fn(session, ...),
+            fetched in batches of batch rows (default 1000). Each stream uses
+            its own session, connection and thread, since DBAPI connections
+            should not move between threads; at most limit streams are open
+            at once. Rows stay attached to the stream's session until the
+            iteration finishes.
+        """
+        batch = kwargs.pop('batch', 1000)
+        if self._stream_slots is None:
+            self._stream_slots = asyncio.Semaphore(self.limit)
+        loop = asyncio.get_running_loop()
+        async with self._stream_slots:
+            executor = ThreadPoolExecutor(max_workers=1)
+            session = await loop.run_in_executor(executor, self._new_session)
+            try:
+                rows = []
+
+                def fetch():
+                    # The query runs when it is first iterated, so the
+                    # iterator is made here in the worker thread, never on
+                    # the event loop.
+                    if not rows:
+                        rows.append(iter(query_fn(session, *args, **kwargs)
+                                         .yield_per(batch)))
+                    chunk = []
+                    for row in rows[0]:
+                        chunk.append(row)
+                        if len(chunk) >= batch:
+                            break
+                    return chunk
+
+                while True:
+                    chunk = await loop.run_in_executor(executor, fetch)
+                    for row in chunk:
+                        yield row
+                    if len(chunk) < batch:
+                        break
+            finally:
+                await loop.run_in_executor(executor, session.close)
+                executor.shutdown(wait=False)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+
+
+def _location_equipment(session, sap_fl):
+    return [eq for device_type in eqdb.SAPEquipment.all_subclasses()
+            for eq in session.query(device_type)
+            .filter(device_type.functional_location.like(sap_fl + '%'))]
+
+
+async def sap_equipment_for_locations(sap, sap_fls):
+    """ Return a dict of SAP functional location: list of equipment of every
+        type under it, looking up the locations concurrently.
+    """
+    sap_fls = list(sap_fls)
+    return dict(zip(sap_fls, await sap.map(_location_equipment, sap_fls)))
+
+
+async def _count_sap_equipment(limit):
+    sap_fls = [l.sap_fl for l in aspendb.get_all_subs()]
+    async with AsyncDatabase.sap(limit=limit) as sap:
+        found = await sap_equipment_for_locations(sap, sap_fls)
+    for sap_fl in sap_fls:
+        print(sap_fl, len(found[sap_fl]))
+
+
+if __name__ == '__main__':
+    asyncio.run(_count_sap_equipment(8))
+    sys.exit()
@@ -0,0 +1,150 @@
+# Benchmark harness for the report scripts.
+#
+# Builds (or reuses) synthetic Aspen and SAP databases with synthdb.py, points
+# aspendb and eqdb at them and runs each report script end to end, timing
+# every run. Script output is discarded; the CSV and Excel files are written
+# to an output directory under the work directory.
+#
+# Example:
+#   python benchmark.py --substations 50 --relays 12 --repeat 3
+#   python benchmark.py --workdir output/bench --reuse compare
+#   python benchmark.py --reuse --query-stats output/bench/stats.json dtt
+#
+# dtt_rx_timers.py is not included because it uses MSSQL specific SQL through
+# a raw pymssql connection; dtt_rx_timers2.py runs the same workload through
+# the ORM.
+from __future__ import print_function
+
+import argparse
+import contextlib
+import os
+import runpy
+import sys
+import time
+
+import aspendb
+import eqdb
+import synthdb
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Workload name and the script that runs it
+WORKLOADS = [('compare', 'sap_aspen_relay_compare.py'),
+             ('dtt', 'dtt_rx_timers2.py'),
+             ('ri_rb', 'moore_ri_rb.py')]
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Discard anything the scripts print while timing them. """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def run_workload(script, workdir):
+    """ Run a report script as __main__ in workdir and return the elapsed
+        time in seconds.
+    """
+    path = os.path.join(SCRIPT_DIR, script)
+    argv = sys.argv
+    sys.argv = [path]
+    try:
+        with working_directory(workdir), quiet():
+            start = timer()
+            try:
+                runpy.run_path(path, run_name='__main__')
+            except SystemExit:
+                pass
+            return timer() - start
+    finally:
+        sys.argv = argv
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the report scripts against synthetic databases.')
+    parser.add_argument('workloads', nargs='*',
+                        help='workloads to run: %s (default all)' %
+                        ', '.join(w for w, s in WORKLOADS))
+    parser.add_argument('--workdir', default=os.path.join('output', 'bench'))
+    parser.add_argument('--reuse', action='store_true',
+                        help='reuse databases already in workdir')
+    parser.add_argument('--substations', type=int, default=20)
+    parser.add_argument('--relays', type=int, default=10,
+                        help='relays per substation')
+    parser.add_argument('--requests', type=int, default=3,
+                        help='setting requests per relay')
+    parser.add_argument('--settings', type=int, default=200,
+                        help='settings per request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--query-stats', metavar='JSON', nargs='?',
+                        const='1',
+                        help='print query statistics at exit and '
+                             'optionally write them to a JSON file')
+    args = parser.parse_args(argv)
+
+    if args.query_stats:
+        os.environ['QUERY_STATS'] = args.query_stats
+
+    workdir = os.path.abspath(args.workdir)
+    aspen_path = os.path.join(workdir, 'aspen.sqlite')
+    sap_path = os.path.join(workdir, 'sap.sqlite')
+    if args.reuse and os.path.exists(aspen_path) and \
+            os.path.exists(sap_path):
+        aspen_url = 'sqlite:///' + aspen_path
+        sap_url = 'sqlite:///' + sap_path
+    else:
+        print('Building synthetic databases in %s' % workdir)
+        start = timer()
+        aspen_url, sap_url = synthdb.build(
+            workdir, substations=args.substations,
+            relays_per_station=args.relays,
+            requests_per_relay=args.requests,
+            settings_per_request=args.settings, seed=args.seed)
+        print('Built in %.2f s' % (timer() - start))
+
+    aspendb.engine_url = aspen_url
+    eqdb.engine_url = sap_url
+    output_dir = os.path.join(workdir, 'output')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    selected = args.workloads or [w for w, s in WORKLOADS]
+    unknown = set(selected) - set(w for w, s in WORKLOADS)
+    if unknown:
+        parser.error('unknown workload: %s' % ', '.join(sorted(unknown)))
+    results = []
+    for name, script in WORKLOADS:
+        if name not in selected:
+            continue
+        times = [run_workload(script, workdir) for n in range(args.repeat)]
+        results.append((name, min(times), sum(times) / len(times)))
+
+    print('%-10s %10s %10s' % ('workload', 'best (s)', 'mean (s)'))
+    for name, best, mean in results:
+        print('%-10s %10.3f %10.3f' % (name, best, mean))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+# Parallel bulk extraction of the Aspen settings tables to local files.
+#
+# TSETTING1 (and TDEVSETTING1 for RTU settings) is split into requestid
+# ranges holding roughly equal numbers of rows. The ranges are read
+# concurrently over several connections, one per worker and reused for every
+# range it takes, as plain tuples in large fetchmany batches, and each one is
+# written straight to its own columnar file:
+#   <output>/<table>/part-00000.parquet    with pyarrow installed
+#   <output>/<table>/part-00000.pickle     otherwise, read with read_part()
+#
+# Example:
+#   python bulk_extract.py --connections 4 --output output/extract
+#   python bulk_extract.py --table TDEVSETTING1 --format pickle
+#
+# Under Python 2 this needs the futures backport of concurrent.futures
+# (listed in environment.yml).
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from sqlalchemy import Integer, Float, Date, DateTime
+
+import aspendb
+
+# Table name: (ORM class, partition key column)
+TABLES = {'TSETTING1': (aspendb.Setting, 'requestid'),
+          'TDEVSETTING1': (aspendb.RTUSetting, 'requestid')}
+
+DEFAULT_BATCH = 50000
+
+
+def connect():
+    """ Return a raw DBAPI connection producing tuple rows. """
+    return aspendb.raw_connect()
+
+
+def columns(table):
+    """ Return the list of database column names extracted from a table. """
+    cls, key = TABLES[table]
+    return [c.name for c in cls.__table__.columns]
+
+
+def partition_bounds(table, partitions):
+    """ Split table into up to partitions requestid ranges with about equal
+        row counts, using NTILE over the key. Returns a sorted list of lower
+        bounds; partition n covers bounds[n] <= key < bounds[n + 1], and the
+        last one everything from its bound up.
+    """
+    cls, key = TABLES[table]
+    con = connect()
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT MIN(%(key)s) FROM ('
+                    'SELECT %(key)s, NTILE(%(n)d) OVER (ORDER BY %(key)s) '
+                    'AS tile FROM %(table)s) t GROUP BY tile'
+                    % {'key': key, 'n': partitions, 'table': table})
+        return sorted(set(row[0] for row in cur.fetchall()))
+    finally:
+        con.close()
+
+
+def _arrow_schema(table):
+    import pyarrow as pa
+    cls, key = TABLES[table]
+    fields = []
+    for c in cls.__table__.columns:
+        if isinstance(c.type, Integer):
+            t = pa.int64()
+        elif isinstance(c.type, Float):
+            t = pa.float64()
+        elif isinstance(c.type, DateTime):
+            t = pa.timestamp('ms')
+        elif isinstance(c.type, Date):
+            t = pa.date32()
+        else:
+            t = pa.string()
+        fields.append(pa.field(c.name, t))
+    return pa.schema(fields)
+
+
+class ParquetPartWriter(object):
+    extension = '.parquet'
+
+    def __init__(self, path, table):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = _arrow_schema(table)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, cols):
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(col, type=field.type)
+             for col, field in zip(cols, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class PicklePartWriter(object):
+    """ Columnar file without third party libraries: a header with the
+        column names followed by one pickled list of column lists per batch.
+    """
+    extension = '.pickle'
+
+    def __init__(self, path, table):
+        self.f = open(path, 'wb')
+        pickle.dump(columns(table), self.f, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, cols):
+        pickle.dump([list(col) for col in cols], self.f,
+                    pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.f.close()
+
+
+WRITERS = {'parquet': ParquetPartWriter, 'pickle': PicklePartWriter}
+
+
+def read_part(path):
+    """ Read a pickle format partition file. Returns a dict of column name:
+        list of values.
+    """
+    with open(path, 'rb') as f:
+        names = pickle.load(f)
+        data = [[] for n in names]
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                break
+            for col, values in zip(data, batch):
+                col.extend(values)
+    return dict(zip(names, data))
+
+
+def extract_partition(table, n, lower, upper, directory, fmt='parquet',
+                      batch=DEFAULT_BATCH, con=None):
+    """ Extract rows with lower <= key < upper (no upper limit if upper is
+        None) to partition file n over con, or a connection of its own if
+        con is None. Returns (n, rows, seconds).
+    """
+    start = time.time()
+    cls, key = TABLES[table]
+    writer_cls = WRITERS[fmt]
+    path = os.path.join(directory, 'part-%05d%s' % (n, writer_cls.extension))
+    sql = 'SELECT %s FROM %s WHERE %s >= %d' % (', '.join(columns(table)),
+                                                 table, key, lower)
+    if upper is not None:
+        sql += ' AND %s < %d' % (key, upper)
+
+    own_con = con is None
+    if own_con:
+        con = connect()
+    writer = writer_cls(path, table)
+    rows = 0
+    try:
+        cur = con.cursor()
+        cur.arraysize = batch
+        cur.execute(sql)
+        while True:
+            chunk = cur.fetchmany(batch)
+            if not chunk:
+                break
+            rows += len(chunk)
+            writer.write(list(zip(*chunk)))
+        cur.close()
+    finally:
+        writer.close()
+        if own_con:
+            con.close()
+    return n, rows, time.time() - start
+
+
+def extract_worker(table, work, directory, fmt='parquet',
+                   batch=DEFAULT_BATCH):
+    """ Extract the (n, lower, upper) partitions taken from the work queue
+        over one connection until the queue is empty. Returns the list of
+        extract_partition() results.
+    """
+    results = []
+    con = connect()
+    try:
+        while True:
+            try:
+                n, lower, upper = work.get_nowait()
+            except queue.Empty:
+                return results
+            results.append(extract_partition(table, n, lower, upper,
+                                             directory, fmt, batch, con))
+    finally:
+        con.close()
+
+
+def extract(table='TSETTING1', directory=os.path.join('output', 'extract'),
+            connections=4, partitions=None, fmt=None, batch=DEFAULT_BATCH,
+            processes=False):
+    """ Extract table to partition files under directory/table using
+        connections concurrent connections. Partitions default to four per
+        connection, handed out from a queue so faster ranges do not leave
+        connections idle; each worker keeps its connection open across the
+        partitions it extracts. fmt is 'parquet' or 'pickle', default
+        parquet if pyarrow is installed. Set processes to decode rows in
+        worker processes instead of threads. Returns a list of (partition,
+        rows, seconds).
+    """
+    if fmt is None:
+        try:
+            import pyarrow.parquet
+            fmt = 'parquet'
+        except ImportError:
+            fmt = 'pickle'
+    if partitions is None:
+        partitions = connections * 4
+    directory = os.path.join(directory, table)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    bounds = partition_bounds(table, partitions)
+    uppers = bounds[1:] + [None]
+    if processes:
+        manager = multiprocessing.Manager()
+        work = manager.Queue()
+        executor_cls = ProcessPoolExecutor
+    else:
+        manager = None
+        work = queue.Queue()
+        executor_cls = ThreadPoolExecutor
+    for n, (lower, upper) in enumerate(zip(bounds, uppers)):
+        work.put((n, lower, upper))
+    try:
+        with executor_cls(max_workers=connections) as executor:
+            futures = [executor.submit(extract_worker, table, work, directory,
+                                       fmt, batch)
+                       for n in range(min(connections, len(bounds)))]
+            return sorted(r for f in futures for r in f.result())
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract an Aspen settings table to local files.')
+    parser.add_argument('--table', default='TSETTING1',
+                        choices=sorted(TABLES))
+    parser.add_argument('--output', default=os.path.join('output', 'extract'))
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--partitions', type=int)
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH,
+                        help='rows per fetch')
+    parser.add_argument('--format', choices=sorted(WRITERS))
+    parser.add_argument('--processes', action='store_true',
+                        help='use worker processes instead of threads')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    results = extract(args.table, args.output, args.connections,
+                      args.partitions, args.format, args.batch,
+                      args.processes)
+    rows = sum(r[1] for r in results)
+    elapsed = time.time() - start
+    print('Extracted %d rows of %s in %d partitions in %.1f s (%.0f rows/s)'
+          % (rows, args.table, len(results), elapsed,
+             rows / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
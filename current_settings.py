@@ -0,0 +1,218 @@
+# Local cache of every relay's currently in-service settings.
+#
+# Most reports only look at the settings of each relay's latest in-service
+# request. This keeps those rows, one per relay and setting, in a local SQLite
+# file built from aspendb.current_settings_query() so audits scan the current
+# state instead of joining the whole TREQUEST/TSETTING1 history.
+#
+# refresh() is incremental: only relays with a request changed since the last
+# refresh (by TREQUEST.dlastchanged) are re-queried. Deleted requests and
+# relays moved between locations are not seen by an incremental refresh; run
+# with --rebuild (or CurrentSettings.build()) periodically to pick those up.
+#
+# Example:
+#   python current_settings.py                    refresh the default cache
+#   python current_settings.py --rebuild
+#
+#   cache = current_settings.CurrentSettings()
+#   cache.refresh(aspendb.get_orm_session())
+#   for row in cache.query(settingname='OUT101', locationid='MOORE'):
+#       print(row['relayid'], row['setting'])
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+
+from sqlalchemy import func
+
+import aspendb
+from aspendb import Request
+import sqlutil
+
+DEFAULT_PATH = os.path.join('output', 'current_settings.sqlite')
+
+# Relays re-queried per statement during an incremental refresh
+CHUNK_SIZE = 500
+
+COLUMNS = ('relayid', 'locationid', 'relaytype', 'requestid', 'request_date',
+           'groupname', 'rownumber', 'settingname', 'setting')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS current_setting (
+    relayid INTEGER NOT NULL,
+    locationid TEXT,
+    relaytype TEXT,
+    requestid INTEGER NOT NULL,
+    request_date TEXT,
+    groupname TEXT,
+    rownumber REAL,
+    settingname TEXT,
+    setting TEXT
+);
+CREATE INDEX IF NOT EXISTS current_setting_relay
+    ON current_setting (relayid);
+CREATE INDEX IF NOT EXISTS current_setting_name
+    ON current_setting (settingname, relaytype);
+CREATE INDEX IF NOT EXISTS current_setting_location
+    ON current_setting (locationid);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _parse_datetime(value):
+    if value is None:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError('Bad watermark %r' % (value,))
+
+
+class CurrentSettings(object):
+    def __init__(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.row_factory = sqlite3.Row
+        self.con.executescript(SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    @property
+    def watermark(self):
+        """ Latest TREQUEST.dlastchanged seen, or None if never built. """
+        row = self.con.execute(
+            "SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return None if row is None else _parse_datetime(row[0])
+
+    def _set_watermark(self, value):
+        if value is None:
+            return
+        self.con.execute("INSERT OR REPLACE INTO meta (key, value) "
+                         "VALUES ('watermark', ?)", (str(value),))
+
+    def _insert(self, rows):
+        self.con.executemany(
+            'INSERT INTO current_setting (%s) VALUES (%s)'
+            % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+            ((r.relayid, r.locationid, r.relaytype, r.requestid,
+              None if r.request_date is None else r.request_date.isoformat(),
+              r.groupname, r.rownumber, r.settingname, r.setting)
+             for r in rows))
+
+    def build(self, session):
+        """ Replace the cache contents with a full rebuild. Returns the number
+            of setting rows cached.
+        """
+        watermark = session.query(func.max(Request.dlastchanged)).scalar()
+        with self.con:
+            self.con.execute('DELETE FROM current_setting')
+            self._insert(aspendb.current_settings_query(session)
+                         .yield_per(10000))
+            self._set_watermark(watermark)
+        return self.count()
+
+    def refresh(self, session):
+        """ Bring the cache up to date, rebuilding only relays with requests
+            changed since the last refresh. Returns the list of relay ids
+            that were refreshed, or None after a full build.
+        """
+        since = self.watermark
+        if since is None:
+            self.build(session)
+            return None
+        # >=: a request committed after the last refresh can carry the same
+        # dlastchanged as the watermark. Rebuilding those relays again is
+        # harmless.
+        changed = session.query(Request.relayid,
+                                func.max(Request.dlastchanged)) \
+            .filter(Request.dlastchanged >= since) \
+            .group_by(Request.relayid) \
+            .all()
+        relay_ids = sorted(int(r[0]) for r in changed if r[0] is not None)
+        watermark = max([r[1] for r in changed] + [since])
+        with self.con:
+            for chunk in sqlutil.chunks(relay_ids, CHUNK_SIZE):
+                self.con.execute(
+                    'DELETE FROM current_setting WHERE relayid IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk)
+                self._insert(aspendb.current_settings_query(session, chunk))
+            self._set_watermark(watermark)
+        return relay_ids
+
+    def count(self):
+        return self.con.execute(
+            'SELECT COUNT(*) FROM current_setting').fetchone()[0]
+
+    def query(self, settingname=None, locationid=None, relaytype=None,
+              relayid=None):
+        """ Return cached rows (sqlite3.Row, indexable by column name)
+            matching all of the given criteria. settingname and relaytype
+            may use SQL LIKE wildcards.
+        """
+        where = []
+        params = []
+        for column, value, op in (('settingname', settingname, 'LIKE'),
+                                  ('relaytype', relaytype, 'LIKE'),
+                                  ('locationid', locationid, '='),
+                                  ('relayid', relayid, '=')):
+            if value is not None:
+                where.append('%s %s ?' % (column, op))
+                params.append(value)
+        sql = 'SELECT %s FROM current_setting' % ', '.join(COLUMNS)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY relayid, groupname, rownumber'
+        return self.con.execute(sql, params).fetchall()
+
+    def query_relays(self, relay_ids):
+        """ Return cached rows for a list of relay ids. """
+        rows = []
+        for chunk in sqlutil.chunks(list(relay_ids), CHUNK_SIZE):
+            rows.extend(self.con.execute(
+                'SELECT %s FROM current_setting WHERE relayid IN (%s) '
+                'ORDER BY relayid, groupname, rownumber'
+                % (', '.join(COLUMNS), ', '.join('?' * len(chunk))), chunk))
+        return rows
+
+    def settings(self, relayid):
+        """ Return a dict of settingname: setting for one relay. """
+        return dict((r['settingname'], r['setting'])
+                    for r in self.query(relayid=relayid))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Refresh the local cache of in-service relay settings.')
+    parser.add_argument('--path', default=DEFAULT_PATH)
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the whole cache')
+    args = parser.parse_args(argv)
+
+    session = aspendb.get_orm_session()
+    cache = CurrentSettings(args.path)
+    if args.rebuild:
+        print('Cached %d settings' % cache.build(session))
+    else:
+        refreshed = cache.refresh(session)
+        if refreshed is None:
+            print('Cached %d settings' % cache.count())
+        else:
+            print('Refreshed %d relays, %d settings cached'
+                  % (len(refreshed), cache.count()))
+    cache.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
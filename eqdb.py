@@ -3,15 +3,16 @@
 # https://pypi.python.org/pypi/cx_Oracle/
 # The version (32-bit or 64-bit, 11g or 12c) must match the installed Oracle
 # client dll.
+#
+# cx_Oracle and the connection settings in eqdb_config are only imported when
+# a connection is made, so the models can be imported without either.
 import sys
 
-import cx_Oracle
-
-# Connection information for SAP equipment database
-from eqdb_config import user, password, tns, schema
-
 
 def connect():
+    import cx_Oracle
+    # Connection information for SAP equipment database
+    from eqdb_config import user, password, tns, schema
     con = cx_Oracle.Connection(user, password, tns)
     if schema is not None:
         con.current_schema = schema
@@ -40,9 +41,12 @@ def simple_connect_test(argv=None):
 import sqlalchemy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Unicode, Float
+from sqlalchemy import Column, Integer, Unicode, Float, event, text
 from sqlalchemy.ext.hybrid import hybrid_property
 
+import query_stats
+import rawfetch
+
 Base = declarative_base()
 
 
@@ -164,14 +168,75 @@ class Comm_Interface(SAPEquipment):
     baseline = Column(Unicode)
 
 
+# SQLAlchemy URL overriding the Oracle connection, e.g. a synthetic SQLite
+# database built by synthdb.py for benchmarking. None uses connect().
+engine_url = None
+
+# Rows fetched per round trip on Oracle cursors, and prefetched with the
+# execute (cx_Oracle 8 and later). cx_Oracle defaults to 100 and 2.
+ARRAYSIZE = 5000
+
+# Oracle allows at most 1000 expressions in an IN list
+IN_LIST_LIMIT = 1000
+
+# SYS.ODCINUMBERLIST is a VARRAY(32767) (ORA-22165 beyond that)
+ODCI_LIST_LIMIT = 32767
+
+
+def _tune_cursor(conn, cursor, statement, parameters, context, executemany):
+    cursor.arraysize = ARRAYSIZE
+    try:
+        cursor.prefetchrows = ARRAYSIZE + 1
+    except AttributeError:
+        pass  # cx_Oracle before 8
+
+
 def get_orm_sessionmaker():
-    engine = sqlalchemy.create_engine(
-        'oracle+cx_oracle://',
-        creator=connect,
-        echo=False)
+    if engine_url is not None:
+        engine = sqlalchemy.create_engine(engine_url, echo=False)
+    else:
+        engine = sqlalchemy.create_engine(
+            'oracle+cx_oracle://',
+            creator=connect,
+            echo=False)
+        event.listen(engine, 'before_cursor_execute', _tune_cursor)
+    query_stats.instrument_from_env(engine, 'eqdb')
     return sessionmaker(bind=engine)
 
 
+def raw_connect():
+    """ Return a raw DBAPI connection: cx_Oracle, or the engine_url database
+        when that is set.
+    """
+    if engine_url is not None:
+        engine = sqlalchemy.create_engine(engine_url,
+                                          poolclass=sqlalchemy.pool.NullPool)
+        return engine.raw_connection()
+    return connect()
+
+
+def fetch_rows(sql, params=None, batch=rawfetch.BATCH):
+    """ Run sql on a new raw connection and return a rawfetch.Result of
+        tuple rows, fetched batch rows per round trip.
+    """
+    con = raw_connect()
+    try:
+        return rawfetch.fetch_rows(con, sql, params, batch)
+    finally:
+        con.close()
+
+
+def fetch_columns(sql, params=None, batch=rawfetch.BATCH):
+    """ Run sql on a new raw connection and return an OrderedDict of column
+        name: list of values.
+    """
+    con = raw_connect()
+    try:
+        return rawfetch.fetch_columns(con, sql, params, batch)
+    finally:
+        con.close()
+
+
 def _abort_ro(*args, **kwargs):
     """ Monkey patch function for session flush to make it read-only.
         Based on code at https://writeonly.wordpress.com/2009/07/16/
@@ -189,6 +254,45 @@ def get_orm_session(readonly=True):
     return session
 
 
+def get_equipment(session, sap_eq_nums, array_bind=None,
+                  chunk_size=IN_LIST_LIMIT):
+    """ Return a dict of SAP equipment number: equipment, of any equipment
+        type, for the numbers in sap_eq_nums that exist. Numbers not found
+        are left out.
+        On Oracle (or when array_bind is set) the numbers are bound as
+        SYS.ODCINUMBERLIST collections of up to ODCI_LIST_LIMIT numbers, one
+        query per collection and equipment table. Otherwise they are looked
+        up in IN lists of chunk_size numbers.
+    """
+    keys = sorted(set(int(k) for k in sap_eq_nums if k is not None))
+    if not keys:
+        return {}
+    if array_bind is None:
+        array_bind = session.get_bind().dialect.name == 'oracle'
+    if array_bind:
+        list_type = session.connection().connection \
+            .gettype('SYS.ODCINUMBERLIST')
+        key_lists = [list_type.newobject(keys[n:n + ODCI_LIST_LIMIT])
+                     for n in range(0, len(keys), ODCI_LIST_LIMIT)]
+
+    rtn = {}
+    for device_type in SAPEquipment.all_subclasses():
+        if array_bind:
+            column = device_type.sap_eq_num.property.columns[0]
+            criteria = [text('%s.%s IN (SELECT column_value FROM '
+                             'TABLE(:sap_eq_nums))'
+                             % (device_type.__tablename__, column.name))
+                        .bindparams(sap_eq_nums=key_list)
+                        for key_list in key_lists]
+        else:
+            criteria = [device_type.sap_eq_num.in_(keys[n:n + chunk_size])
+                        for n in range(0, len(keys), chunk_size)]
+        for c in criteria:
+            for eq in session.query(device_type).filter(c):
+                rtn[eq.sap_eq_num] = eq
+    return rtn
+
+
 def orm_connect_test(argv=None):
     if argv is None:
         argv = sys.argv
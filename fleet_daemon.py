@@ -0,0 +1,381 @@
+# Long-running query service holding the relay fleet in memory.
+#
+# Loads locations, relays, RTU equipment and SAP equipment once, together
+# with every relay's in-service settings from the current_settings cache,
+# indexes them in memory and answers small lookups over HTTP (on a TCP port
+# or a Unix socket) in milliseconds instead of a cold script start per
+# lookup. The model is refreshed in the background: in-service settings
+# incrementally through current_settings, the much smaller equipment tables
+# by reloading them.
+#
+# Endpoints (all return JSON):
+#   /status                      load time, counts and last refresh
+#   /locations                   all locations
+#   /locations/<id>              one location with its relays and RTUs
+#   /relays/<id>                 one relay with its in-service settings
+#   /settings?name=&relaytype=&location=&value=
+#                                in-service settings matching all given
+#                                filters; SQL LIKE wildcards % and _ allowed
+#   /compare/<location id>       Aspen/SAP differences for one location
+#
+# Example:
+#   python fleet_daemon.py --port 8765 --refresh 600
+#   curl 'http://localhost:8765/settings?name=OUT10%&location=MOORE'
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+import aspendb
+import current_settings
+import eqdb
+import sap_aspen_relay_compare
+import sqlutil
+
+
+def _columns(obj):
+    """ Return the mapped column attributes of an ORM object as a dict. """
+    return dict((attr.key, getattr(obj, attr.key))
+                for attr in obj.__mapper__.column_attrs)
+
+
+def _dict_table(title, fmt, rows):
+    """ Return a sap_aspen_relay_compare.Table of the report's fields over
+        column dicts. Columns a dict does not have are AttributeMissing, as
+        for an ORM class without the attribute.
+    """
+    table = sap_aspen_relay_compare.Table(title,
+                                          sap_aspen_relay_compare.fields, fmt)
+    table.data = [tuple(row[f] if f in row else missing
+                        for f, missing in zip(table.field_names,
+                                              table.missing))
+                  for row in rows]
+    return table
+
+
+class FleetModel(object):
+    """ In-memory indexes over the Aspen and SAP equipment and the
+        in-service settings.
+    """
+    def __init__(self, cache_path=current_settings.DEFAULT_PATH):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.refreshed = None
+        self.load_seconds = None
+        self.locations = {}
+        self.relays = {}
+        self.rtus = {}
+        self.relays_by_location = {}
+        self.rtus_by_location = {}
+        self.sap = {}  # sap_eq_num -> equipment dict
+        self.sap_by_location = {}
+        self.settings_by_relay = {}  # relayid -> list of setting dicts
+        self.settings_by_name = {}  # settingname -> list of setting dicts
+
+    def load_equipment(self, aspen_sess, sap_sess):
+        """ Reload locations and equipment from both databases. """
+        locations = dict((l.id, _columns(l))
+                         for l in aspen_sess.query(aspendb.Location))
+        relays = dict((r.id, _columns(r))
+                      for r in aspen_sess.query(aspendb.Relay))
+        rtus = dict((r.id, _columns(r))
+                    for r in aspen_sess.query(aspendb.RTU_Equipment))
+        relays_by_location = {}
+        for r in relays.values():
+            relays_by_location.setdefault(r['locationid'], []).append(r['id'])
+        rtus_by_location = {}
+        for r in rtus.values():
+            rtus_by_location.setdefault(r['locationid'], []).append(r['id'])
+
+        # SAP equipment belongs to every location whose SAP functional
+        # location is a prefix of its own, as in the compare report.
+        locations_by_fl = {}
+        for l in locations.values():
+            if l['sap_fl'] is not None:
+                locations_by_fl.setdefault(l['sap_fl'], []).append(l['id'])
+        sap = {}
+        sap_by_location = {}
+        for device_type in eqdb.SAPEquipment.all_subclasses():
+            for eq in sap_sess.query(device_type):
+                eq_dict = _columns(eq)
+                eq_dict['table'] = device_type.__tablename__
+                sap[eq.sap_eq_num] = eq_dict
+                fl = eq.functional_location or ''
+                for n in range(len(fl) + 1):
+                    for location in locations_by_fl.get(fl[:n], ()):
+                        sap_by_location.setdefault(location, []) \
+                            .append(eq.sap_eq_num)
+
+        with self.lock:
+            self.locations = locations
+            self.relays = relays
+            self.rtus = rtus
+            self.relays_by_location = relays_by_location
+            self.rtus_by_location = rtus_by_location
+            self.sap = sap
+            self.sap_by_location = sap_by_location
+
+    def load_settings(self, aspen_sess):
+        """ Refresh the current settings cache and load changed relays. """
+        # A new cache connection each time, since refreshes run on the
+        # background thread and sqlite3 connections are tied to a thread.
+        cache = current_settings.CurrentSettings(self.cache_path)
+        try:
+            refreshed = cache.refresh(aspen_sess)
+            if refreshed is None or not self.settings_by_relay:
+                rows = cache.query()
+            else:
+                rows = cache.query_relays(refreshed)
+        finally:
+            cache.close()
+        if refreshed is None or not self.settings_by_relay:
+            settings_by_relay = {}
+        else:
+            settings_by_relay = dict(self.settings_by_relay)
+            for relayid in refreshed:
+                settings_by_relay[relayid] = []
+        for row in rows:
+            settings_by_relay.setdefault(row['relayid'], []) \
+                .append(dict(zip(current_settings.COLUMNS, row)))
+        settings_by_name = {}
+        for settings in settings_by_relay.values():
+            for s in settings:
+                settings_by_name.setdefault(s['settingname'], []).append(s)
+        with self.lock:
+            self.settings_by_relay = settings_by_relay
+            self.settings_by_name = settings_by_name
+
+    def refresh(self):
+        start = time.time()
+        aspen_sess = aspendb.get_orm_session()
+        sap_sess = eqdb.get_orm_session()
+        try:
+            self.load_equipment(aspen_sess, sap_sess)
+            self.load_settings(aspen_sess)
+        finally:
+            aspen_sess.close()
+            sap_sess.close()
+        self.refreshed = time.strftime('%Y-%m-%d %H:%M:%S')
+        if self.loaded is None:
+            self.loaded = self.refreshed
+        self.load_seconds = time.time() - start
+
+    def status(self):
+        return {'loaded': self.loaded,
+                'refreshed': self.refreshed,
+                'refresh_seconds': self.load_seconds,
+                'locations': len(self.locations),
+                'relays': len(self.relays),
+                'rtu_equipment': len(self.rtus),
+                'sap_equipment': len(self.sap),
+                'relays_with_settings': len(self.settings_by_relay)}
+
+    def location(self, location_id):
+        try:
+            rtn = dict(self.locations[location_id])
+        except KeyError:
+            return None
+        rtn['relays'] = [self.relays[r] for r in
+                         self.relays_by_location.get(location_id, [])]
+        rtn['rtu_equipment'] = [self.rtus[r] for r in
+                                self.rtus_by_location.get(location_id, [])]
+        return rtn
+
+    def relay(self, relay_id):
+        try:
+            rtn = dict(self.relays[relay_id])
+        except KeyError:
+            return None
+        rtn['settings'] = self.settings_by_relay.get(relay_id, [])
+        return rtn
+
+    def settings(self, name=None, relaytype=None, location=None,
+                 value=None):
+        """ Return in-service settings matching all given filters. Filters
+            other than location may use SQL LIKE wildcards.
+        """
+        if name is None:
+            candidates = [s for settings in self.settings_by_relay.values()
+                          for s in settings]
+        elif sqlutil.is_pattern(name):
+            match = sqlutil.like(name)
+            candidates = [s for n, settings in self.settings_by_name.items()
+                          if match(n) for s in settings]
+        else:
+            candidates = self.settings_by_name.get(name, [])
+        filters = []
+        if relaytype is not None:
+            match_type = sqlutil.like(relaytype)
+            filters.append(lambda s: match_type(s['relaytype']))
+        if location is not None:
+            filters.append(lambda s: s['locationid'] == location)
+        if value is not None:
+            match_value = sqlutil.like(value)
+            filters.append(lambda s: match_value(s['setting']))
+        return [s for s in candidates if all(f(s) for f in filters)]
+
+    def compare(self, location_id):
+        """ Compare Aspen and SAP equipment at a location by SAP equipment
+            number.
+        """
+        if location_id not in self.locations:
+            return None
+        aspen = {}
+        for r in [self.relays[n] for n in
+                  self.relays_by_location.get(location_id, [])] + \
+                 [self.rtus[n] for n in
+                  self.rtus_by_location.get(location_id, [])]:
+            aspen.setdefault(r['sap_eq_num'], []).append(r)
+        sap = dict((n, self.sap[n])
+                   for n in self.sap_by_location.get(location_id, []))
+        # Compare with the report's fields and diff rules
+        aspen_rows = [d for devices in aspen.values() for d in devices]
+        aspen_table = _dict_table('Aspen', 'aspen', aspen_rows)
+        sap_table = _dict_table('SAP', 'sap', sap.values())
+        match_n, match_field = aspen_table.match_field()
+        mismatches = []
+        for row, row_diff in zip(aspen_table.data,
+                                 aspen_table.data_diff(sap_table)):
+            for n, sap_value in enumerate(row_diff):
+                if sap_value is not sap_aspen_relay_compare.Table.ValuesMatch:
+                    mismatches.append({'sap_eq_num': row[match_n],
+                                       'field': aspen_table.field_names[n],
+                                       'aspen': row[n],
+                                       'sap': sap_value})
+        return {'location': location_id,
+                'missing_from_sap': [d for k, devices in aspen.items()
+                                     for d in devices
+                                     if k is None or k not in sap],
+                'missing_from_aspen': [eq for k, eq in sap.items()
+                                       if k not in aspen],
+                'mismatches': mismatches}
+
+
+class FleetRequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        model = self.server.model
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        rtn = None
+        try:
+            if parts == ['status']:
+                rtn = model.status()
+            elif parts == ['locations']:
+                rtn = sorted(model.locations.values(), key=lambda l: l['id'])
+            elif len(parts) == 2 and parts[0] == 'locations':
+                rtn = model.location(parts[1])
+            elif len(parts) == 2 and parts[0] == 'relays':
+                rtn = model.relay(int(parts[1]))
+            elif parts == ['settings']:
+                rtn = model.settings(**params)
+            elif len(parts) == 2 and parts[0] == 'compare':
+                rtn = model.compare(parts[1])
+        except (TypeError, ValueError) as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+        if rtn is None:
+            self.send_json({'error': 'not found'}, 404)
+        else:
+            self.send_json(rtn)
+
+
+class FleetServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixFleetServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        # Attributes BaseHTTPRequestHandler expects from HTTPServer
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def refresh_loop(model, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            model.refresh()
+        except Exception as e:
+            # Keep serving the previous model if a refresh fails
+            print('Refresh failed: %s' % (e,), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve relay fleet lookups from an in-memory model.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='listen on a Unix socket instead')
+    parser.add_argument('--refresh', type=float, default=900,
+                        help='seconds between background refreshes')
+    parser.add_argument('--cache', default=current_settings.DEFAULT_PATH,
+                        help='current settings cache file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    model = FleetModel(args.cache)
+    model.refresh()
+    print('Loaded in %.1f s: %s' % (model.load_seconds,
+                                    json.dumps(model.status())))
+    thread = threading.Thread(target=refresh_loop,
+                              args=(model, args.refresh))
+    thread.daemon = True
+    thread.start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixFleetServer(args.socket, FleetRequestHandler)
+        print('Listening on %s' % args.socket)
+    else:
+        server = FleetServer((args.host, args.port), FleetRequestHandler)
+        print('Listening on http://%s:%d/' % (args.host, args.port))
+    server.model = model
+    server.verbose = args.verbose
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
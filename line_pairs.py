@@ -0,0 +1,261 @@
+# Compare the settings of the relays at both ends of each protected line.
+#
+# Relay.protecting names the element a relay protects, e.g.
+# 'MOORE - THEDFORD 230KV LINE' at MOORE and 'THEDFORD-MOORE 230 KV LN' at
+# THEDFORD. The text is normalized to the sorted pair of end names, the
+# voltage and any circuit number, and relays are indexed by that key across
+# every location. Relays with the same key at different locations are paired
+# and their latest in-service settings, fetched in batches, are compared:
+#   - DTT receive timers: the pickup delay of the AST timer driving each
+#     '#DTT CHn RX ...' output, read from its 'ASTnnPT := x' AUTO setting in
+#     each logic group, compared by output label and group
+#   - communication scheme settings (SCHEME_SETTINGS), compared between
+#     relays of the same type, group by group
+# Settings are kept by (groupname, settingname), since SEL relays repeat the
+# same setting names in each settings group.
+#
+# Example:
+#   python line_pairs.py                    writes output/line_pairs.csv
+#   python line_pairs.py --cache --setting Z2PD --setting 'E%'
+from __future__ import print_function
+
+import argparse
+import csv
+import os
+import re
+import sys
+
+import aspendb
+import current_settings
+import settings_index
+import sqlutil
+from aspendb import Relay
+
+DEFAULT_OUTPUT = os.path.join('output', 'line_pairs.csv')
+
+# Setting name LIKE patterns compared between paired relays of the same type
+SCHEME_SETTINGS = ('ECOMM', 'EPOTT', 'EDCUB', 'Z2PD', 'Z3RBD', 'EBLKD',
+                   'ETDPU', 'EDURD', 'TDURD', '67QTC')
+
+voltage_re = re.compile(r'([0-9]+(?:\.[0-9]+)?) *KV')
+circuit_re = re.compile(r'(?:#|\bCKT\b|\bCIRCUIT\b|\bNO\.?) *([0-9]+)')
+ends_re = re.compile(r' *(?:-|\bTO\b) *')
+noise_re = re.compile(r'\b(?:LINE|LN|TRANSMISSION|XMSN|TIE)\b')
+# DTT output, e.g. 'AST01Q #DTT CH1 RX FAIL'
+dtt_output = re.compile(r'(AST[0-9]+)Q +#(DTT.*)')
+
+COLUMNS = ['LINE', 'ITEM', 'RELAY_A', 'LOCATION_A', 'RELAYTYPE_A', 'VALUE_A',
+           'RELAY_B', 'LOCATION_B', 'RELAYTYPE_B', 'VALUE_B']
+
+
+def normalize_protecting(protecting):
+    """ Return the key (sorted end names, voltage, circuit) for a protected
+        line description, or None if it does not name two ends.
+    """
+    if not protecting:
+        return None
+    text = ' '.join(protecting.upper().split())
+    m = voltage_re.search(text)
+    if m is None:
+        voltage = None
+    else:
+        voltage = float(m.group(1))
+        text = text[:m.start()] + text[m.end():]
+    m = circuit_re.search(text)
+    if m is None:
+        circuit = None
+    else:
+        circuit = int(m.group(1))
+        text = text[:m.start()] + text[m.end():]
+    text = noise_re.sub(' ', text)
+    ends = [' '.join(e.split()) for e in ends_re.split(text.strip())]
+    ends = [e for e in ends if e]
+    if len(ends) != 2:
+        return None
+    return tuple(sorted(ends)), voltage, circuit
+
+
+def describe(key):
+    (a, b), voltage, circuit = key
+    rtn = '%s - %s' % (a, b)
+    if voltage is not None:
+        rtn += ' %gKV' % voltage
+    if circuit is not None:
+        rtn += ' #%d' % circuit
+    return rtn
+
+
+def line_index(session):
+    """ Return a dict of line key: list of relay rows (id, locationid,
+        relaytype, protecting) for every relay with a recognizable
+        protected line.
+    """
+    index = {}
+    for r in session.query(Relay.id, Relay.locationid, Relay.relaytype,
+                           Relay.protecting):
+        key = normalize_protecting(r.protecting)
+        if key is not None:
+            index.setdefault(key, []).append(r)
+    return index
+
+
+def pairs(index):
+    """ Yield (line key, relay A, relay B) for relays on the same line at
+        different locations. Where both ends have relays of a type, only
+        relays of the same type are paired.
+    """
+    for key in sorted(index, key=describe):
+        relays = index[key]
+        for n, a in enumerate(relays):
+            for b in relays[n + 1:]:
+                if a.locationid == b.locationid:
+                    continue
+                types_a = set(r.relaytype for r in relays
+                              if r.locationid == a.locationid)
+                types_b = set(r.relaytype for r in relays
+                              if r.locationid == b.locationid)
+                if a.relaytype != b.relaytype and \
+                        (a.relaytype in types_b or b.relaytype in types_a):
+                    continue
+                if a.locationid > b.locationid:
+                    a, b = b, a
+                yield key, a, b
+
+
+def latest_settings(session, relay_ids, cache=None):
+    """ Return a dict of relay id: {(groupname, settingname): setting} of the
+        latest in-service request of each relay, fetched CHUNK_SIZE relays
+        per query, or from a current_settings.CurrentSettings cache.
+    """
+    rtn = dict((relay_id, {}) for relay_id in relay_ids)
+    relay_ids = sorted(rtn)
+    if cache is not None:
+        rows = cache.query_relays(relay_ids)
+    else:
+        rows = []
+        for chunk in sqlutil.chunks(relay_ids, current_settings.CHUNK_SIZE):
+            rows.extend(aspendb.current_settings_query(session, chunk))
+    for r in rows:
+        rtn[r[0]][(r[5], r[7])] = r[8]
+    return rtn
+
+
+def dtt_timers(settings):
+    """ Return a dict of (DTT output label, group): timer pickup delay for
+        one relay's settings, with one entry per settings group that sets
+        the timer's delay. An output whose timer delay is not set in any
+        group has the single entry (label, None): None.
+    """
+    delays = {}  # timer name -> {groupname: delay}
+    for (group, name), setting in settings.items():
+        for target, value in settings_index.parse_setting(name, setting):
+            delays.setdefault(target, {})[group] = value
+    rtn = {}
+    for setting in settings.values():
+        m = dtt_output.match(setting or '')
+        if m:
+            label = ' '.join(m.group(2).split())
+            timer = delays.get(m.group(1) + 'PT', {None: None})
+            for group, delay in timer.items():
+                rtn[(label, group)] = delay
+    return rtn
+
+
+def _item(name, group):
+    return name if group is None else '%s (%s)' % (name, group)
+
+
+def _group_key(key):
+    return tuple('' if k is None else k for k in key)
+
+
+def _same(a, b):
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return (a or '').strip() == (b or '').strip()
+
+
+def compare_pair(a, b, settings_a, settings_b, patterns=SCHEME_SETTINGS):
+    """ Return a list of (item, value A, value B) of the asymmetric DTT
+        timers and scheme settings of two paired relays.
+    """
+    rtn = []
+    timers_a = dtt_timers(settings_a)
+    timers_b = dtt_timers(settings_b)
+    for key in sorted(set(timers_a) | set(timers_b), key=_group_key):
+        value_a = timers_a.get(key, 'missing')
+        value_b = timers_b.get(key, 'missing')
+        if value_a != value_b:
+            label, group = key
+            rtn.append((_item(label + ' delay', group), value_a, value_b))
+    if a.relaytype == b.relaytype:
+        matches = [sqlutil.like(p) for p in patterns]
+        for key in sorted(settings_a, key=_group_key):
+            group, name = key
+            if not any(match(name) for match in matches):
+                continue
+            if key in settings_b and \
+                    not _same(settings_a[key], settings_b[key]):
+                rtn.append((_item(name, group), settings_a[key],
+                            settings_b[key]))
+    return rtn
+
+
+def compare_lines(session, cache=None, patterns=SCHEME_SETTINGS):
+    """ Return a list of dicts, one per asymmetric item of every pair of
+        relays at the two ends of a line, with the keys in COLUMNS.
+    """
+    line_pairs = list(pairs(line_index(session)))
+    relay_ids = set()
+    for key, a, b in line_pairs:
+        relay_ids.update((a.id, b.id))
+    settings = latest_settings(session, relay_ids, cache)
+    rtn = []
+    for key, a, b in line_pairs:
+        for item, value_a, value_b in compare_pair(
+                a, b, settings[a.id], settings[b.id], patterns):
+            rtn.append({'LINE': describe(key), 'ITEM': item,
+                        'RELAY_A': a.id, 'LOCATION_A': a.locationid,
+                        'RELAYTYPE_A': a.relaytype, 'VALUE_A': value_a,
+                        'RELAY_B': b.id, 'LOCATION_B': b.locationid,
+                        'RELAYTYPE_B': b.relaytype, 'VALUE_B': value_b})
+    return rtn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report settings that differ between the relays at the '
+                    'two ends of each protected line.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--cache', nargs='?',
+                        const=current_settings.DEFAULT_PATH,
+                        help='read settings from the current settings cache')
+    parser.add_argument('--setting', action='append',
+                        help='scheme setting name LIKE pattern to compare '
+                             '(default %s); may be repeated'
+                             % ', '.join(SCHEME_SETTINGS))
+    args = parser.parse_args(argv)
+
+    session = aspendb.get_orm_session()
+    cache = None
+    if args.cache:
+        cache = current_settings.CurrentSettings(args.cache)
+    rows = compare_lines(session, cache, args.setting or SCHEME_SETTINGS)
+    if cache is not None:
+        cache.close()
+
+    if sys.version_info[0] >= 3:
+        csvfile = open(args.output, 'w', newline='')
+    else:
+        csvfile = open(args.output, 'wb')
+    with csvfile:
+        csvout = csv.DictWriter(csvfile, COLUMNS)
+        csvout.writeheader()
+        csvout.writerows(rows)
+    print('%d asymmetric settings on %d lines written to %s'
+          % (len(rows), len(set(r['LINE'] for r in rows)), args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
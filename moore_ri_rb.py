@@ -1,44 +1,51 @@
 import aspendb
-from aspendb import Location, Relay, Request, Setting, SettingInfo
-import re
+from aspendb import Relay, Request
+from sqlalchemy.orm import contains_eager, selectinload
 import sys
 import csv
 
-session = aspendb.get_orm_session() # Using SQLAlchemy interface
-        
-location_id = 'MOORE'
-request_list = session.query(Request)\
-                .join(Relay)\
-                .filter(Relay.locationid == location_id,
-                        Relay.relaytype.like('SEL-421%'),
-                        Request.status == 'IN SERVICE')\
-                .order_by(Relay.protecting)\
-                .all()
-
-print('Number returned', len(request_list))
-
-
-for r in request_list:
-    r.RB_setting = session.query(Setting)\
-        .join(SettingInfo)\
-        .join(Request)\
-        .filter(SettingInfo.settingname == 'OUT101',
-                Setting.requestid==r.id).first().setting
-
-    r.RI_setting = session.query(Setting)\
-        .join(SettingInfo)\
-        .join(Request)\
-        .filter(SettingInfo.settingname == 'OUT103',
-                Setting.requestid==r.id).first().setting
-
-with open('output/moore_ri_rb.csv', 'w') as csvfile:
-    csvout = csv.DictWriter(csvfile,
-                            ['LOCATIONID', 'DEVICE', 'PROTECTING', 'REQUEST_YEAR', 'RB_RI'],
-                            lineterminator = '\n',
-                            extrasaction = 'ignore')
-    csvout.writeheader()
-    csvout.writerows([{'LOCATIONID': r.relay.locationid,
-                      'DEVICE': r.relay.device_num,
-                      'PROTECTING': r.relay.protecting,
-                      'REQUEST_YEAR': r.request_date.year if r.request_date is not None else '',
-                      'RB_RI': '\n'.join(['RB = '+r.RB_setting, 'RI = '+r.RI_setting])} for r in request_list])
+
+def setting_value(request, settingname):
+    for s in request.settings:
+        if s.settinginfo.settingname == settingname:
+            return s.setting
+
+
+def main(argv=None):
+    session = aspendb.get_orm_session() # Using SQLAlchemy interface
+
+    location_id = 'MOORE'
+    # Relays (from the join used to filter them) and settings are loaded with
+    # the requests, so the loop below does not go back to the database for
+    # each request.
+    request_list = session.query(Request)\
+                    .join(Request.relay)\
+                    .options(contains_eager(Request.relay),
+                             selectinload(Request.settings))\
+                    .filter(Relay.locationid == location_id,
+                            Relay.relaytype.like('SEL-421%'),
+                            Request.status == 'IN SERVICE')\
+                    .order_by(Relay.protecting)\
+                    .all()
+
+    print('Number returned', len(request_list))
+
+    for r in request_list:
+        r.RB_setting = setting_value(r, 'OUT101')
+        r.RI_setting = setting_value(r, 'OUT103')
+
+    with open('output/moore_ri_rb.csv', 'w') as csvfile:
+        csvout = csv.DictWriter(csvfile,
+                                ['LOCATIONID', 'DEVICE', 'PROTECTING', 'REQUEST_YEAR', 'RB_RI'],
+                                lineterminator = '\n',
+                                extrasaction = 'ignore')
+        csvout.writeheader()
+        csvout.writerows([{'LOCATIONID': r.relay.locationid,
+                          'DEVICE': r.relay.device_num,
+                          'PROTECTING': r.relay.protecting,
+                          'REQUEST_YEAR': r.request_date.year if r.request_date is not None else '',
+                          'RB_RI': '\n'.join(['RB = '+r.RB_setting, 'RI = '+r.RI_setting])} for r in request_list])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
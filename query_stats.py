@@ -0,0 +1,261 @@
+# Query instrumentation for the aspendb and eqdb SQLAlchemy engines.
+#
+# Records the latency of every statement, the rows fetched from its cursor
+# (or affected, for statements returning none) and whether it was fired by a
+# lazy relationship load, grouped by the call site in our own code that caused
+# it. Repeated statements from one call site (the N+1 pattern, e.g.
+# s.request.relay in a loop) are flagged in the summary.
+#
+# Enable for any script by setting the QUERY_STATS environment variable:
+#   QUERY_STATS=1              print a summary at exit
+#   QUERY_STATS=stats.json     print a summary and also write it as JSON
+#
+# or attach explicitly with query_stats.instrument(engine, 'label').
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import event
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# Frames from these directories are library code, not call sites
+_SKIP_DIRS = (os.path.dirname(sqlalchemy.__file__),
+              os.path.dirname(os.path.abspath(__file__)) + os.sep +
+              'query_stats.py')
+# SQLAlchemy functions that only appear on the stack of a lazy load
+_LAZY_FUNCTIONS = ('_load_for_state', '_emit_lazyload')
+
+# Executions of one statement from one call site before it is reported as a
+# likely N+1 pattern
+N_PLUS_ONE_THRESHOLD = 10
+
+
+class StatementStats(object):
+    """ Totals for one statement issued from one call site. """
+    __slots__ = ('statement', 'count', 'total', 'max', 'rows', 'lazy')
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.lazy = 0
+
+    def as_dict(self):
+        return {'statement': self.statement,
+                'count': self.count,
+                'total_s': self.total,
+                'max_s': self.max,
+                'rows': self.rows,
+                'lazy_loads': self.lazy}
+
+
+class _CountingCursor(object):
+    """ DBAPI cursor proxy adding the rows fetched through it to a
+        StatementStats.
+    """
+    __slots__ = ('_cursor', '_stats', '_lock')
+
+    def __init__(self, cursor, stats, lock):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_stats', stats)
+        object.__setattr__(self, '_lock', lock)
+
+    def _count(self, n):
+        if n:
+            with self._lock:
+                self._stats.rows += n
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class QueryStats(object):
+    """ Collects statement statistics from one or more engines.
+
+        Rows are counted as they are fetched from the cursor, by giving the
+        statement's result a counting proxy of it; for statements without a
+        result (UPDATE, DELETE) the DBAPI rowcount is used.
+    """
+    def __init__(self):
+        self.stats = {}  # (label, call site, statement) -> StatementStats
+        self.lock = threading.Lock()
+        self.engines = []
+        self.start = timer()
+
+    def instrument(self, engine, label):
+        """ Attach to engine. label names the database in the summary. """
+        if any(e is engine for e, l in self.engines):
+            return
+        self.engines.append((engine, label))
+
+        def before(conn, cursor, statement, parameters, context,
+                   executemany):
+            context._query_stats = (timer(),) + call_site()
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            try:
+                start, site, lazy = context._query_stats
+            except AttributeError:
+                return
+            elapsed = timer() - start
+            key = (label, site, statement)
+            with self.lock:
+                try:
+                    s = self.stats[key]
+                except KeyError:
+                    s = self.stats[key] = StatementStats(statement)
+                s.count += 1
+                s.total += elapsed
+                s.max = max(s.max, elapsed)
+                if lazy:
+                    s.lazy += 1
+                if cursor.description is None:
+                    rowcount = getattr(cursor, 'rowcount', -1)
+                    if rowcount is not None and rowcount > 0:
+                        s.rows += rowcount
+            if cursor.description is not None and context.cursor is cursor:
+                # The result is set up from context.cursor after this event
+                context.cursor = _CountingCursor(cursor, s, self.lock)
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    def sites(self):
+        """ Return per call site totals as a list of dicts, slowest first. """
+        sites = {}
+        with self.lock:
+            items = list(self.stats.items())
+        for (label, site, statement), s in items:
+            try:
+                rec = sites[(label, site)]
+            except KeyError:
+                rec = sites[(label, site)] = {
+                    'database': label, 'call_site': site, 'count': 0,
+                    'total_s': 0.0, 'rows': 0, 'lazy_loads': 0,
+                    'statements': []}
+            rec['count'] += s.count
+            rec['total_s'] += s.total
+            rec['rows'] += s.rows
+            rec['lazy_loads'] += s.lazy
+            rec['statements'].append(s.as_dict())
+        rtn = sorted(sites.values(), key=lambda r: -r['total_s'])
+        for rec in rtn:
+            rec['statements'].sort(key=lambda s: -s['total_s'])
+            rec['n_plus_one'] = any(s['count'] >= N_PLUS_ONE_THRESHOLD
+                                    for s in rec['statements'])
+        return rtn
+
+    def summary(self, out=None, limit=20):
+        """ Print a summary of the slowest call sites. """
+        if out is None:
+            out = sys.stderr
+        sites = self.sites()
+        count = sum(r['count'] for r in sites)
+        total = sum(r['total_s'] for r in sites)
+        print('=' * 80, file=out)
+        print('Query statistics: %d statements, %.3f s in database, '
+              '%.3f s elapsed' % (count, total, timer() - self.start),
+              file=out)
+        print('=' * 80, file=out)
+        print('%7s %9s %9s %8s %6s  %s' % ('calls', 'total s', 'mean ms',
+                                           'rows', 'lazy', 'call site'),
+              file=out)
+        for r in sites[:limit]:
+            print('%7d %9.3f %9.2f %8d %6d  %s:%s%s'
+                  % (r['count'], r['total_s'],
+                     1000.0 * r['total_s'] / r['count'], r['rows'],
+                     r['lazy_loads'], r['database'], r['call_site'],
+                     '  <-- N+1' if r['n_plus_one'] else ''), file=out)
+            slowest = r['statements'][0]['statement']
+            print('%7s %s' % ('', ' '.join(slowest.split())[:120]), file=out)
+        if len(sites) > limit:
+            print('... %d more call sites' % (len(sites) - limit), file=out)
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'elapsed_s': timer() - self.start,
+                       'sites': self.sites()}, f, indent=2)
+
+
+def call_site():
+    """ Return (call site, lazy) for the current statement. The call site is
+        'file:line function' of the innermost frame outside SQLAlchemy and
+        this module; lazy is True if a lazy relationship load is on the
+        stack.
+    """
+    frame = sys._getframe(1)
+    lazy = False
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name in _LAZY_FUNCTIONS:
+            lazy = True
+        if not code.co_filename.startswith(_SKIP_DIRS):
+            return ('%s:%d %s' % (os.path.basename(code.co_filename),
+                                  frame.f_lineno, code.co_name), lazy)
+        frame = frame.f_back
+    return '(unknown)', lazy
+
+
+# Shared collector so statements from both databases end up in one summary
+collector = None
+
+
+def instrument(engine, label):
+    """ Attach the shared collector to engine, creating it and registering
+        the exit summary on first use. Returns the collector.
+    """
+    global collector
+    if collector is None:
+        collector = QueryStats()
+        atexit.register(_report, os.environ.get('QUERY_STATS'))
+    collector.instrument(engine, label)
+    return collector
+
+
+def instrument_from_env(engine, label):
+    """ Instrument engine if the QUERY_STATS environment variable is set. """
+    if os.environ.get('QUERY_STATS'):
+        return instrument(engine, label)
+    return None
+
+
+def _report(setting):
+    if collector is None or not collector.stats:
+        return
+    collector.summary()
+    if setting and setting.lower().endswith('.json'):
+        collector.dump_json(setting)
@@ -0,0 +1,156 @@
+# Low-overhead bulk fetching from raw DBAPI connections.
+#
+# pymssql with as_dict=True builds a dict per row, and the ORM a keyed row
+# object; for bulk reads of millions of settings rows that per-row cost
+# dominates. These helpers run a query on a raw connection returning plain
+# tuples, fetched BATCH rows per fetchmany() call, and either
+#   - keep the tuples, with one column name: index map shared by the whole
+#     result (fetch_rows), or
+#   - transpose each batch straight into per-column lists (fetch_columns).
+# Rows can still be read by column name through Row, a tuple subclass whose
+# class holds the shared column map, so no per-row dict is ever built.
+#
+# aspendb.fetch_rows()/fetch_columns() and eqdb.fetch_rows()/fetch_columns()
+# open the connection; the SQL uses the paramstyle of that driver (%s for
+# pymssql, :name for cx_Oracle, ? for SQLite).
+#
+# Example:
+#   result = aspendb.fetch_rows('SELECT ID, LOCATIONID FROM TRELAY')
+#   location = result.columns['LOCATIONID']
+#   for row in result.rows:
+#       print(row[0], row[location])
+#   for row in result:                  # Row views
+#       print(row['ID'], row.LOCATIONID)
+#
+#   columns = aspendb.fetch_columns('SELECT REQUESTID, SETTING FROM TSETTING1')
+#   len(columns['REQUESTID'])
+from __future__ import print_function
+
+from collections import OrderedDict
+
+# Rows per fetchmany() call
+BATCH = 10000
+
+
+class Row(tuple):
+    """ Tuple row also readable by column name, row['NAME'] or row.NAME.
+        Subclasses made by row_class() hold the column map of one result.
+    """
+    __slots__ = ()
+    names = ()
+    columns = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        return tuple.__getitem__(self, self.columns[key])
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self.columns[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return list(self.names)
+
+    def as_dict(self):
+        return dict(zip(self.names, self))
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % i for i in zip(self.names,
+                                                                self))
+
+
+def row_class(names):
+    """ Return a Row subclass for rows with the given column names. """
+    names = tuple(names)
+    return type('Row', (Row,), {
+        '__slots__': (), 'names': names,
+        'columns': dict((name, n) for n, name in enumerate(names))})
+
+
+class Result(object):
+    """ Rows of a query as plain tuples, with the column map shared by all of
+        them. Iterating yields Row views, built one at a time.
+    """
+    def __init__(self, names, rows):
+        self.names = tuple(names)
+        self.columns = dict((name, n) for n, name in enumerate(self.names))
+        self.rows = rows
+        self.row_class = row_class(self.names)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        row_class = self.row_class
+        return (row_class(row) for row in self.rows)
+
+    def __getitem__(self, n):
+        return self.row_class(self.rows[n])
+
+    def column(self, name):
+        """ Return the list of values of one column. """
+        n = self.columns[name]
+        return [row[n] for row in self.rows]
+
+
+def column_names(cursor):
+    return [d[0] for d in cursor.description]
+
+
+def batches(cursor, batch=BATCH):
+    """ Yield lists of up to batch rows from an executed cursor. """
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        yield rows
+
+
+def _execute(con, sql, params, batch):
+    cur = con.cursor()
+    try:
+        # Rows per round trip for drivers that use it, such as cx_Oracle
+        cur.arraysize = batch
+    except AttributeError:
+        pass
+    if params is None:
+        cur.execute(sql)
+    else:
+        cur.execute(sql, params)
+    return cur
+
+
+def fetch_rows(con, sql, params=None, batch=BATCH):
+    """ Run sql on a raw connection returning tuple rows and return a Result.
+    """
+    cur = _execute(con, sql, params, batch)
+    rows = []
+    for chunk in batches(cur, batch):
+        rows.extend(chunk)
+    names = column_names(cur)
+    cur.close()
+    return Result(names, rows)
+
+
+def fetch_columns(con, sql, params=None, batch=BATCH):
+    """ Run sql on a raw connection returning tuple rows and return an
+        OrderedDict of column name: list of values, transposing each batch
+        as it is fetched.
+    """
+    cur = _execute(con, sql, params, batch)
+    names = column_names(cur)
+    values = [[] for name in names]
+    for chunk in batches(cur, batch):
+        for column, chunk_values in zip(values, zip(*chunk)):
+            column.extend(chunk_values)
+    cur.close()
+    return OrderedDict(zip(names, values))
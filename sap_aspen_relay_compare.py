@@ -1,26 +1,21 @@
 from __future__ import print_function, unicode_literals
 
+import argparse
 import eqdb
 import aspendb
 import csv  # Use UnicodeWriter from https://docs.python.org/2/library/csv.html
 import codecs
-import xlsxwriter  # Documentation at https://xlsxwriter.readthedocs.io/
+import hashlib
 import io  # for using csv.writer to write to a string and UnicodeWriter class
+import operator
+import os
+import pickle
+import sys
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
-wb = xlsxwriter.Workbook('output/SAP-Aspen Relay Compare.xlsx')
-
-# Set up database connections
-aspen_sess = aspendb.get_orm_session()
-sap_sess = eqdb.get_orm_session()
-
-# Locations to check
-# aspen_location first, then sap_fl
-locations = list((l.id, l.sap_fl) for l in aspendb.get_all_subs())
-
 # match_field can be set to 'sap_eq_num' or 'district_num'
 # 'sap_eq_num' seems to provide better matching results.
 match_field = 'sap_eq_num'
@@ -122,13 +117,19 @@ class UnicodeWriter:
         self.encoder = codecs.getincrementalencoder(encoding)()
 
     def writerow(self, row):
-        self.writer.writerow([str(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
+        if sys.version_info[0] >= 3:
+            # Python 3 csv writes text directly
+            self.writer.writerow([str(s) for s in row])
+            data = self.queue.getvalue()
+        else:
+            self.writer.writerow([str(s).encode("utf-8") for s in row])
+            # Fetch UTF-8 output from the queue ...
+            data = self.queue.getvalue()
+            data = data.decode("utf-8")
         # write to the target stream
         self.stream.write(data)
         # empty queue
+        self.queue.seek(0)
         self.queue.truncate(0)
 
     def writerows(self, rows):
@@ -151,25 +152,36 @@ class AttributeMissing(object):
 
 
 class Table(object):
-    def __init__(self, title, fields, fmt):
+    def __init__(self, title, fields, fmt, wb=None):
+        """ wb is the xlsxwriter Workbook the table will be written to, if
+            any.
+        """
         self.title = title
         self.fields = fields
         self.fmt = fmt
         self.headers = self.row_info('header')
-        self.obj_list = []  # List of objects represented in table
-        self.data = []  # List of rows, starts empty
+        self.field_names = self.row_info('field')
+        # One AttributeMissing per column, shared by every row missing it
+        self.missing = [AttributeMissing(f) for f in self.field_names]
+        # Row extraction functions compiled per source class by extractor()
+        self.extractors = {}
+        self.data = []  # List of row tuples, starts empty
         self.highlights = []  # List of rows, starts empty
         self.comments = []  # List of rows, starts empty
         # Header row of Excel table. Only saved when written to Excel.
         self.header_row = None
 
         # Some defaults saved in the class
-        self.header_format = wb.add_format({'bold': True,
-                                            'text_wrap': True,
-                                            'align': 'center',
-                                            'valign': 'bottom',
-                                            'bottom': 1})
-        self.diff_format = wb.add_format({'bg_color': 'yellow'})
+        if wb is not None:
+            self.header_format = wb.add_format({'bold': True,
+                                                'text_wrap': True,
+                                                'align': 'center',
+                                                'valign': 'bottom',
+                                                'bottom': 1})
+            self.diff_format = wb.add_format({'bg_color': 'yellow'})
+        else:
+            self.header_format = None
+            self.diff_format = None
 
     def row_info(self, kind):
         data = []
@@ -180,27 +192,66 @@ class Table(object):
                 data.append(f[self.fmt + '_' + kind])
         return data
 
-    def mk_row(self, eq):
-        """ If missing_attributes is True, then missing attributes are 
-            indicated with an AttributeMissing object, otherwise an empty string 
-            is used.
+    def extractor(self, eq):
+        """ Return a function making a row tuple from objects of the same
+            class as eq. The attributes present are found once per class and
+            read together with one itemgetter on the instance __dict__, where
+            loaded ORM column values and plain attributes live, falling back
+            to attribute access for anything not loaded yet. Missing
+            attributes are indicated with the column's AttributeMissing
+            object.
         """
-        fields = self.row_info('field')
-        data = []
-        for f in fields:
+        cls = type(eq)
+        try:
+            return self.extractors[cls]
+        except KeyError:
+            pass
+        present = [n for n, f in enumerate(self.field_names)
+                   if hasattr(eq, f)]
+        names = [self.field_names[n] for n in present]
+        item_getter = operator.itemgetter(*names)
+        attr_getter = operator.attrgetter(*names)
+        if len(names) == 1:
+            item_getter = lambda d, get=item_getter: (get(d),)
+            attr_getter = lambda eq, get=attr_getter: (get(eq),)
+
+        def values(eq):
             try:
-                data.append(getattr(eq, f))
-            except AttributeError:
-                # Flag missing attribute with AttributeMissing object
-                data.append(AttributeMissing(f))
-        return data
+                return item_getter(eq.__dict__)
+            except KeyError:
+                return attr_getter(eq)
+
+        if len(present) == len(self.field_names):
+            extract = values
+        else:
+            template = list(self.missing)
+
+            def extract(eq):
+                row = list(template)
+                for n, value in zip(present, values(eq)):
+                    row[n] = value
+                return tuple(row)
+        self.extractors[cls] = extract
+        return extract
+
+    def mk_row(self, eq):
+        """ Return a tuple of the table fields of eq. Missing attributes are
+            indicated with an AttributeMissing object.
+        """
+        try:
+            return self.extractor(eq)(eq)
+        except AttributeError:
+            # Attribute set on some instances of the class but not this one
+            data = []
+            for f, missing in zip(self.field_names, self.missing):
+                data.append(getattr(eq, f, missing))
+            return tuple(data)
 
     def mk_data_rows(self, eq_list):
-        self.obj_list = []
-        self.data = []
-        for eq in eq_list:
-            self.obj_list.append(eq)
-            self.data.append(self.mk_row(eq))
+        """ Set the table data from a list of objects. Only the row tuples
+            are kept, not the objects.
+        """
+        self.data = [self.mk_row(eq) for eq in eq_list]
 
     def match_field(self):
         """ Based on the fields set for the Table, return a tuple of the 
@@ -210,7 +261,7 @@ class Table(object):
         for n, field in enumerate(self.fields):
             try:
                 if field['match']:
-                    return n, self.row_info('field')[n]
+                    return n, self.field_names[n]
             except KeyError:
                 continue
         return None, None
@@ -246,7 +297,7 @@ class Table(object):
         cross_ref = {}
         for row2 in table2.data:
             match_data = row2[match_n]
-            if not (match_data is None or match_data is ''):
+            if not (match_data is None or match_data == ''):
                 cross_ref[match_data] = row2
 
         # Iterate through data rows and look for differences
@@ -278,13 +329,27 @@ class Table(object):
                 rtn = out.getvalue()
             return rtn
 
-    def xl_write(self, sheet, style='Table Style Medium 2', diff=None):
+    def xl_write(self, sheet, style='Table Style Medium 2', diff=None,
+                 name=None, diff_style='comments', discrepancy_sheet=None):
         """ Writes table out to Excel sheet starting at current cursor row 
             position. Adds Excel table formatting if possible.
             If diff is set to another Table, then differences against the 
             other table will be highlighted and the other table's value 
-            indicated as a comment.
+            shown according to diff_style:
+                'comments'  as a comment on the cell
+                'columns'   in a block of columns to the right of the table,
+                            one per checked field, filled in for differences
+                'hidden'    as 'columns', with the block hidden
+            The 'columns' and 'hidden' styles highlight with one conditional
+            format per checked field driven by the block, avoiding the
+            per-cell comments that are slow to write and open.
+            If discrepancy_sheet is set to a sheet, every difference is also
+            listed there, one per row, starting at its current cursor row.
+            The Excel table is named from name (default the title) and the
+            table's fmt.
         """
+        if name is None:
+            name = self.title
         xl_write(sheet, self.title)
         self.header_row = sheet.cur_row  # Keep track or header row number
         xl_write_row(sheet, self.headers, self.header_format)
@@ -303,12 +368,25 @@ class Table(object):
                                           'header_format': self.header_format}
                                          for s in self.headers],
                              'style': style,
-                             'name': xl_safe_tablename(aspen_location +
-                                                       '_' + self.fmt)})
+                             'name': xl_safe_tablename(name + '_' + self.fmt)})
 
-        # Add diff highlighting
-        if diff is not None:
-            diff_table = self.data_diff(diff)
+        if diff is None:
+            return
+        diff_table = self.data_diff(diff)
+        match_n, match_name = self.match_field()
+        if discrepancy_sheet is not None:
+            for row_n, diff_row in enumerate(diff_table):
+                for n, value2 in enumerate(diff_row):
+                    if value2 is not Table.ValuesMatch:
+                        xl_write_row(discrepancy_sheet,
+                                     [name, self.title,
+                                      skip_none(self.data[row_n][match_n]),
+                                      self.headers[n],
+                                      skip_none(self.data[row_n][n]),
+                                      skip_none(value2)])
+
+        if diff_style == 'comments':
+            # Add diff highlighting
             for row_n, diff_row in enumerate(diff_table):
                 for n, value2 in enumerate(diff_row):
                     if value2 is Table.ValuesMatch:
@@ -323,6 +401,41 @@ class Table(object):
                         value2 = '(blank)'
                     sheet.write_comment(r, n, value2, {'y_scale': 0.33,
                                                        'x_scale': 1.5})
+            return
+
+        from xlsxwriter.utility import xl_rowcol_to_cell
+
+        # Other table's values in a block after a blank column, one column
+        # per checked field. A cell in the block is only filled for a
+        # difference, and conditional formatting highlights the table cells
+        # whose block cell is filled.
+        check_fields = self.check_fields()
+        block_col = len(self.headers) + 1
+        other = {'aspen': 'Aspen', 'sap': 'SAP'}.get(diff.fmt, diff.fmt)
+        for k, n in enumerate(check_fields):
+            sheet.write(self.header_row, block_col + k,
+                        other + ' ' + diff.headers[n], self.header_format)
+        for row_n, diff_row in enumerate(diff_table):
+            for k, n in enumerate(check_fields):
+                value2 = diff_row[n]
+                if value2 is Table.ValuesMatch:
+                    continue
+                if skip_none(value2) == '':
+                    value2 = '(blank)'
+                sheet.write(self.header_row + row_n + 1, block_col + k,
+                            value2)
+        if diff_style == 'hidden':
+            sheet.set_column(block_col, block_col + len(check_fields) - 1,
+                             None, None, {'hidden': True})
+        if self.data:
+            first = self.header_row + 1
+            last = self.header_row + len(self.data)
+            for k, n in enumerate(check_fields):
+                sheet.conditional_format(first, n, last, n, {
+                    'type': 'formula',
+                    'criteria': '=LEN(%s)>0' % xl_rowcol_to_cell(
+                        first, block_col + k),
+                    'format': self.diff_format})
 
 
 def xl_set_formatting(sheet):
@@ -331,26 +444,48 @@ def xl_set_formatting(sheet):
     for n, w in enumerate((10, 13, 14.5, 33, 14, 28, 24, 15, 35, 10)):
         sheet.set_column(n, n, w)
 
-for aspen_location, sap_fl in locations:
-    print('='*80)
-    print('Checking location %s / %s' % (aspen_location, sap_fl))
-    sheet = wb.add_worksheet(aspen_location.replace('*', '_'))
+def xl_discrepancy_sheet(wb):
+    """ Add a sheet listing differences, for Table.xl_write(), and write
+        its headers.
+    """
+    sheet = wb.add_worksheet('Discrepancies')
     sheet.cur_row = 0
-    xl_set_formatting(sheet)
+    xl_write_row(sheet, ['Location', 'Table', 'SAP Equipment Number',
+                         'Field', 'Value', 'Other Value'],
+                 wb.add_format({'bold': True, 'bottom': 1}))
+    for n, w in enumerate((12, 22, 13, 20, 30, 30)):
+        sheet.set_column(n, n, w)
+    sheet.freeze_panes(1, 0)
+    return sheet
+
+
+def sort_key(k):
+    """ Sort key for match field values putting None first and numbers
+        before other values, as Python 2 does, without comparing None, numbers
+        and strings to each other.
+    """
+    if k is None:
+        return (0, 0)
+    if isinstance(k, (int, float)):
+        return (1, k)
+    return (2, k)
+
 
+def location_tables(aspen_sess, sap_sess, aspen_location, sap_fl, wb):
+    """ Query the devices at one location and return the Aspen and SAP
+        tables, with the missing device flags set.
+    """
     # Dict of lists. Key is match field value, set to None if not valid.
     # Each value is a list of devices with that key.
     all_aspen = {}
     all_sap = {}
-    no_aspen_data = []
-    no_sap_data = []
 
     # Aspen Database query list
     for device_type in (aspendb.Relay, aspendb.RTU_Equipment):
         for eq in aspen_sess.query(device_type) \
                 .filter(device_type.locationid == aspen_location):
             data = getattr(eq, match_field)
-            if data is None or data is '':
+            if data is None or data == '':
                 data = None
             try:
                 all_aspen[data].append(eq)
@@ -363,7 +498,7 @@ for aspen_location, sap_fl in locations:
         for eq in sap_sess.query(device_type) \
                 .filter(device_type.functional_location.like(sap_fl + '%')):
             data = getattr(eq, match_field)
-            if data is None or data is '':
+            if data is None or data == '':
                 data = None
             try:
                 all_sap[data].append(eq)
@@ -374,37 +509,340 @@ for aspen_location, sap_fl in locations:
     # Set flags on Aspen equipment list for what is missing in SAP and make
     # master list.
     table_eq_list = []
-    for k in sorted(all_aspen.keys()):
+    for k in sorted(all_aspen.keys(), key=sort_key):
         for eq in all_aspen[k]:
             eq.flag = 'X' if k is None or k not in all_sap else ''
             table_eq_list.append(eq)
-    aspen_table = Table('Devices found in Aspen', fields, 'aspen')
+    aspen_table = Table('Devices found in Aspen', fields, 'aspen', wb)
     aspen_table.mk_data_rows(table_eq_list)
 
     # Set flags on SAP equipment list for what is missing in Aspen and make
     # master list
     table_eq_list = []
-    for k in sorted(all_sap.keys()):
+    for k in sorted(all_sap.keys(), key=sort_key):
         for eq in all_sap[k]:
             eq.flag = 'X' if k is None or k not in all_aspen else ''
             table_eq_list.append(eq)
-    sap_table = Table('Devices found in SAP', fields, 'sap')
+    sap_table = Table('Devices found in SAP', fields, 'sap', wb)
     sap_table.mk_data_rows(table_eq_list)
 
-    # Calculate differences between Aspen and SAP tables
-    diff = aspen_table.data_diff(sap_table)
+    return aspen_table, sap_table
+
+
+def write_location(aspen_location, sap_fl, aspen_table, sap_table, wb,
+                   diff_style='comments', discrepancy_sheet=None):
+    """ Print both tables of a location and write them to a new sheet in
+        workbook wb. diff_style and discrepancy_sheet are passed to
+        Table.xl_write().
+    """
+    print('='*80)
+    print('Checking location %s / %s' % (aspen_location, sap_fl))
+    sheet = wb.add_worksheet(aspen_location.replace('*', '_'))
+    sheet.cur_row = 0
+    xl_set_formatting(sheet)
 
     # Print all rows from Aspen
     print(aspen_table)
-    aspen_table.xl_write(sheet, diff=sap_table)
+    aspen_table.xl_write(sheet, diff=sap_table, name=aspen_location,
+                         diff_style=diff_style,
+                         discrepancy_sheet=discrepancy_sheet)
 
     # Leave a blank row in the worksheet
     sheet.cur_row += 1
 
     # Print all rows from SAP
     print(sap_table)
-    sap_table.xl_write(sheet, diff=aspen_table)
+    sap_table.xl_write(sheet, diff=aspen_table, name=aspen_location,
+                       diff_style=diff_style,
+                       discrepancy_sheet=discrepancy_sheet)
 
     print('')
 
-wb.close()
+
+def compare_location(aspen_sess, sap_sess, aspen_location, sap_fl, wb,
+                     diff_style='comments', discrepancy_sheet=None):
+    """ Compare the devices at one location, print both tables and write
+        them to a new sheet in workbook wb.
+    """
+    aspen_table, sap_table = location_tables(aspen_sess, sap_sess,
+                                             aspen_location, sap_fl, wb)
+    write_location(aspen_location, sap_fl, aspen_table, sap_table, wb,
+                   diff_style, discrepancy_sheet)
+    return aspen_table, sap_table
+
+
+# Incremental mode
+#
+# The state file keeps, for every location checked, a hash of the compared
+# fields of its Aspen and SAP devices together with the table rows and the
+# discrepancies found. The hashes for the whole fleet are computed from one
+# narrow column query per device table. Locations with unchanged hashes are
+# written from the saved rows; only changed locations are queried in detail
+# and diffed again.
+
+DEFAULT_STATE = os.path.join('output', 'compare_state.pickle')
+STATE_VERSION = 2
+
+
+def _column_fields(device_type, names):
+    """ Return the names that are mapped columns of device_type. """
+    columns = set(p.key for p in device_type.__mapper__.column_attrs)
+    return [n for n in names if n in columns]
+
+
+def _hash_rows(rows):
+    digest = hashlib.sha1()
+    for r in sorted(repr(r) for r in rows):
+        digest.update(r.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def location_hashes(aspen_sess, sap_sess, locations):
+    """ Return a dict of Aspen location id: (Aspen hash, SAP hash) for a list
+        of (Aspen location id, SAP functional location), hashing the
+        compared fields of every device at each location.
+    """
+    aspen_rows = dict((l, []) for l, fl in locations)
+    sap_rows = dict((l, []) for l, fl in locations)
+
+    names = Table('', fields, 'aspen').field_names
+    for device_type in (aspendb.Relay, aspendb.RTU_Equipment):
+        columns = _column_fields(device_type, names)
+        for row in aspen_sess.query(device_type.locationid,
+                                    *[getattr(device_type, c)
+                                      for c in columns]):
+            try:
+                aspen_rows[row[0]].append((device_type.__tablename__,) +
+                                          tuple(row[1:]))
+            except KeyError:
+                continue
+
+    # SAP equipment belongs to every location whose SAP functional location
+    # is a prefix of its own, as with the LIKE in location_tables()
+    locations_by_fl = {}
+    for l, fl in locations:
+        locations_by_fl.setdefault(fl, []).append(l)
+    names = Table('', fields, 'sap').field_names
+    for device_type in eqdb.SAPEquipment.all_subclasses():
+        columns = _column_fields(device_type, names)
+        for row in sap_sess.query(device_type.functional_location,
+                                  *[getattr(device_type, c)
+                                    for c in columns]):
+            fl = row[0] or ''
+            for n in range(len(fl) + 1):
+                for l in locations_by_fl.get(fl[:n], ()):
+                    sap_rows[l].append((device_type.__tablename__,) +
+                                       tuple(row[1:]))
+
+    return dict((l, (_hash_rows(aspen_rows[l]), _hash_rows(sap_rows[l])))
+                for l, fl in locations)
+
+
+def _match_value(value):
+    """ Return a match field value, or None if it is blank or missing. """
+    if value is None or value == '' or isinstance(value, AttributeMissing):
+        return None
+    return value
+
+
+def discrepancies(aspen_location, aspen_table, sap_table):
+    """ Return the set of discrepancies between the tables of one location
+        as tuples of (location, match value, header, Aspen value, SAP
+        value). Devices missing from the other database are reported under
+        the flag column header.
+    """
+    match_n, match_name = aspen_table.match_field()
+    flag_n = aspen_table.field_names.index('flag')
+    rtn = set()
+    for table in (aspen_table, sap_table):
+        for row in table.data:
+            if row[flag_n] == 'X':
+                rtn.add((aspen_location, _match_value(row[match_n]),
+                         table.headers[flag_n], None, None))
+    for row, diff_row in zip(aspen_table.data,
+                             aspen_table.data_diff(sap_table)):
+        for n, value2 in enumerate(diff_row):
+            if value2 is not Table.ValuesMatch:
+                rtn.add((aspen_location, _match_value(row[match_n]),
+                         aspen_table.headers[n], skip_none(row[n]),
+                         skip_none(value2)))
+    return rtn
+
+
+def _state_rows(table):
+    """ Return the rows of a table for the state file, as (row, indexes of
+        missing columns). AttributeMissing values are saved as None so the
+        file does not depend on the module that wrote it.
+    """
+    rtn = []
+    for row in table.data:
+        missing = tuple(n for n, value in enumerate(row)
+                        if isinstance(value, AttributeMissing))
+        if missing:
+            row = tuple(None if n in missing else value
+                        for n, value in enumerate(row))
+        rtn.append((row, missing))
+    return rtn
+
+
+def _table_rows(table, rows):
+    """ Return table rows restored from _state_rows(). """
+    rtn = []
+    for row, missing in rows:
+        if missing:
+            row = tuple(table.missing[n] if n in missing else value
+                        for n, value in enumerate(row))
+        rtn.append(row)
+    return rtn
+
+
+def load_state(path):
+    """ Load the incremental state file, returning an empty state if it is
+        missing, unreadable or was written for different fields.
+    """
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except (IOError, OSError):
+        return {}
+    except (pickle.UnpicklingError, AttributeError, EOFError, ImportError,
+            IndexError, TypeError, ValueError) as e:
+        print('Ignoring unreadable state file %s: %s' % (path, e))
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    if state.get('version') != STATE_VERSION or state.get('fields') != fields:
+        return {}
+    return state['locations']
+
+
+def save_state(path, locations):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        pickle.dump({'version': STATE_VERSION, 'fields': fields,
+                     'locations': locations}, f, pickle.HIGHEST_PROTOCOL)
+
+
+def write_changes(sheet, new, resolved):
+    """ Print and write to sheet the discrepancies that are new or resolved
+        since the last run.
+    """
+    headers = ['Change', 'Location', 'SAP Equipment Number', 'Field',
+               'Aspen Value', 'SAP Value']
+    sheet.cur_row = 0
+    xl_write(sheet, 'Changes since last run')
+    xl_write_row(sheet, headers)
+    print('='*80)
+    print('Changes since last run: %d new, %d resolved discrepancies'
+          % (len(new), len(resolved)))
+    print('='*80)
+    for change, items in (('New', new), ('Resolved', resolved)):
+        for d in sorted(items, key=lambda d: [sort_key(v) for v in d]):
+            row = [change] + [skip_none(v) for v in d]
+            print(', '.join('%s' % v for v in row))
+            xl_write_row(sheet, row)
+    print('')
+
+
+def compare_incremental(aspen_sess, sap_sess, locations, wb, state_path,
+                        diff_style='comments', discrepancy_sheet=None):
+    """ Compare locations, re-querying only those whose devices changed
+        since the state file was written, and report the discrepancies that
+        are new or resolved since then. Returns (new, resolved).
+    """
+    state = load_state(state_path)
+    changes_sheet = wb.add_worksheet('Changes')
+    hashes = location_hashes(aspen_sess, sap_sess, locations)
+
+    new = set()
+    resolved = set()
+    for aspen_location, sap_fl in locations:
+        previous = state.get(aspen_location)
+        if previous is not None and previous['sap_fl'] == sap_fl \
+                and previous['hashes'] == hashes[aspen_location]:
+            aspen_table = Table('Devices found in Aspen', fields, 'aspen', wb)
+            aspen_table.data = _table_rows(aspen_table, previous['aspen'])
+            sap_table = Table('Devices found in SAP', fields, 'sap', wb)
+            sap_table.data = _table_rows(sap_table, previous['sap'])
+            write_location(aspen_location, sap_fl, aspen_table, sap_table,
+                           wb, diff_style, discrepancy_sheet)
+            continue
+
+        aspen_table, sap_table = compare_location(
+            aspen_sess, sap_sess, aspen_location, sap_fl, wb, diff_style,
+            discrepancy_sheet)
+        found = discrepancies(aspen_location, aspen_table, sap_table)
+        before = set() if previous is None else previous['discrepancies']
+        new |= found - before
+        resolved |= before - found
+        state[aspen_location] = {'sap_fl': sap_fl,
+                                 'hashes': hashes[aspen_location],
+                                 'aspen': _state_rows(aspen_table),
+                                 'sap': _state_rows(sap_table),
+                                 'discrepancies': found}
+
+    write_changes(changes_sheet, new, resolved)
+    save_state(state_path, state)
+    return new, resolved
+
+
+def main(argv=None):
+    import xlsxwriter  # Documentation at https://xlsxwriter.readthedocs.io/
+
+    parser = argparse.ArgumentParser(
+        description='Compare relay and equipment records in Aspen and SAP.')
+    parser.add_argument('--output',
+                        default='output/SAP-Aspen Relay Compare.xlsx')
+    parser.add_argument('--location', action='append',
+                        help='Aspen location id to check (default all '
+                             'locations with an SAP functional location); '
+                             'may be repeated')
+    parser.add_argument('--incremental', nargs='?', const=DEFAULT_STATE,
+                        metavar='STATE',
+                        help='only re-check locations changed since the '
+                             'last incremental run, using state file STATE '
+                             '(default %s)' % DEFAULT_STATE)
+    parser.add_argument('--diff-style', default='comments',
+                        choices=('comments', 'columns', 'hidden'),
+                        help='show the other database\'s value for each '
+                             'difference as a cell comment (default), in '
+                             'columns beside the table, or in hidden '
+                             'columns')
+    parser.add_argument('--discrepancy-sheet', action='store_true',
+                        help='also list every difference on a '
+                             'Discrepancies sheet')
+    args = parser.parse_args(argv)
+
+    wb = xlsxwriter.Workbook(args.output)
+    if args.discrepancy_sheet:
+        discrepancy_sheet = xl_discrepancy_sheet(wb)
+    else:
+        discrepancy_sheet = None
+
+    # Set up database connections
+    aspen_sess = aspendb.get_orm_session()
+    sap_sess = eqdb.get_orm_session()
+
+    # Locations to check
+    # aspen_location first, then sap_fl
+    locations = list((l.id, l.sap_fl) for l in aspendb.get_all_subs())
+    if args.location:
+        locations = [l for l in locations if l[0] in args.location]
+
+    if args.incremental:
+        compare_incremental(aspen_sess, sap_sess, locations, wb,
+                            args.incremental, args.diff_style,
+                            discrepancy_sheet)
+    else:
+        for aspen_location, sap_fl in locations:
+            compare_location(aspen_sess, sap_sess, aspen_location, sap_fl,
+                             wb, args.diff_style, discrepancy_sheet)
+
+    wb.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
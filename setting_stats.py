@@ -0,0 +1,187 @@
+# Fleet statistics of relay setting values by relay type.
+#
+# For every setting of every relay type, counts how many in-service relays
+# use each value (aspendb.setting_value_counts(), grouped in the database, or
+# the same GROUP BY on the local current settings cache) and reports the
+# histogram, the most common value and outlier candidates: values used by
+# only a few relays where most relays of the type agree on one value.
+#
+# Example:
+#   python setting_stats.py --relaytype SEL-421
+#   python setting_stats.py --setting '50P%' --cache --relays
+#
+#   stats = setting_stats.from_session(aspendb.get_orm_session(), 'SEL-421')
+#   for s in stats:
+#       for value, count in s.outliers():
+#           print(s.settingname, s.mode, value, count)
+from __future__ import print_function
+
+import argparse
+import sys
+
+import aspendb
+import current_settings
+from aspendb import Setting
+
+# A value is an outlier candidate if at most this share of relays use it...
+OUTLIER_SHARE = 0.05
+# ...and the most common value is used by at least this share
+STANDARD_SHARE = 0.8
+
+
+class SettingStats(object):
+    """ Value histogram of one setting of one relay type. """
+    def __init__(self, relaytype, groupname, rownumber, settingname):
+        self.relaytype = relaytype
+        self.groupname = groupname
+        self.rownumber = rownumber
+        self.settingname = settingname
+        self.counts = {}  # setting value: number of relays
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def histogram(self):
+        """ Return a list of (value, relays), most common first. """
+        return sorted(self.counts.items(),
+                      key=lambda c: (-c[1], c[0] is not None, c[0]))
+
+    @property
+    def mode(self):
+        return self.histogram()[0][0]
+
+    @property
+    def mode_share(self):
+        return float(self.histogram()[0][1]) / self.total
+
+    def outliers(self, max_share=OUTLIER_SHARE, min_mode_share=STANDARD_SHARE):
+        """ Return a list of (value, relays) of the values used by at most
+            max_share of relays, if the most common value is used by at least
+            min_mode_share of them. Otherwise the setting has no standard
+            value and nothing is returned.
+        """
+        if self.mode_share < min_mode_share:
+            return []
+        total = float(self.total)
+        return [(value, count) for value, count in self.histogram()[1:]
+                if count / total <= max_share]
+
+
+def collect(rows):
+    """ Return a list of SettingStats from rows of (relaytype, groupname,
+        rownumber, settingname, setting, relays), sorted by relay type and
+        setting position.
+    """
+    stats = {}
+    for relaytype, groupname, rownumber, settingname, setting, relays in rows:
+        key = (relaytype, groupname, rownumber)
+        try:
+            s = stats[key]
+        except KeyError:
+            s = stats[key] = SettingStats(relaytype, groupname, rownumber,
+                                          settingname)
+        s.counts[setting] = s.counts.get(setting, 0) + relays
+    return [stats[k] for k in sorted(stats, key=lambda k: tuple(
+        (v is not None, v) for v in k))]
+
+
+def from_session(session, relaytype=None, settingname=None):
+    """ Setting statistics counted by the Aspen database. """
+    return collect(aspendb.setting_value_counts(session, relaytype,
+                                                settingname))
+
+
+def from_cache(cache, relaytype=None, settingname=None):
+    """ Setting statistics counted from a current_settings.CurrentSettings
+        cache.
+    """
+    where = []
+    params = []
+    for column, value in (('relaytype', relaytype),
+                          ('settingname', settingname)):
+        if value is not None:
+            where.append('%s LIKE ?' % column)
+            params.append(value)
+    sql = ('SELECT relaytype, groupname, rownumber, settingname, setting, '
+           'COUNT(DISTINCT relayid) FROM current_setting')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' GROUP BY relaytype, groupname, rownumber, settingname, setting'
+    return collect(cache.con.execute(sql, params))
+
+
+def relays_with_value(session, stats, value):
+    """ Return the ids of in-service relays using value for the setting of
+        SettingStats stats.
+    """
+    return sorted(r.relayid for r in aspendb.current_settings_query(session)
+                  .filter(Setting.relaytype == stats.relaytype,
+                          Setting.groupname == stats.groupname,
+                          Setting.rownumber == stats.rownumber,
+                          Setting.setting == value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report the distribution of setting values across '
+                    'in-service relays and non-standard values.')
+    parser.add_argument('--relaytype', help='relay type (LIKE pattern)')
+    parser.add_argument('--setting', help='setting name (LIKE pattern)')
+    parser.add_argument('--cache', nargs='?',
+                        const=current_settings.DEFAULT_PATH,
+                        help='count from the current settings cache instead '
+                             'of the Aspen database')
+    parser.add_argument('--max-share', type=float, default=OUTLIER_SHARE)
+    parser.add_argument('--min-mode-share', type=float,
+                        default=STANDARD_SHARE)
+    parser.add_argument('--all', action='store_true',
+                        help='print every histogram, not only settings with '
+                             'outliers')
+    parser.add_argument('--relays', action='store_true',
+                        help='list the relays using each outlier value')
+    args = parser.parse_args(argv)
+
+    # The cache is read offline; the database is only connected without it
+    if args.cache:
+        session = None
+        cache = current_settings.CurrentSettings(args.cache)
+        stats = from_cache(cache, args.relaytype, args.setting)
+    else:
+        session = aspendb.get_orm_session()
+        cache = None
+        stats = from_session(session, args.relaytype, args.setting)
+
+    found = 0
+    for s in stats:
+        outliers = s.outliers(args.max_share, args.min_mode_share)
+        if not (outliers or args.all):
+            continue
+        found += len(outliers)
+        print('%s %s %s (%g): %d relays, mode %r on %.0f%%'
+              % (s.relaytype, s.groupname, s.settingname, s.rownumber,
+                 s.total, s.mode, 100 * s.mode_share))
+        if args.all:
+            for value, count in s.histogram():
+                print('    %6d  %r' % (count, value))
+        for value, count in outliers:
+            line = '    outlier %r on %d' % (value, count)
+            if args.relays:
+                if cache is not None:
+                    relays = sorted(set(
+                        r['relayid'] for r in cache.query(
+                            relaytype=s.relaytype, settingname=s.settingname)
+                        if r['groupname'] == s.groupname and
+                        r['rownumber'] == s.rownumber and
+                        r['setting'] == value))
+                else:
+                    relays = relays_with_value(session, s, value)
+                line += ': ' + ', '.join(str(r) for r in relays)
+            print(line)
+    print('%d settings, %d outlier values' % (len(stats), found))
+    if cache is not None:
+        cache.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
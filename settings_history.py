@@ -0,0 +1,237 @@
+# As-of-date settings of relays, from an interval index over service dates.
+#
+# Each request put in service (status IN SERVICE or HISTORICAL, with a
+# service date) was in effect from its service date until the next such
+# request of the same relay went in service. The index keeps those start
+# dates per relay, sorted, so the request in effect on any date is a binary
+# search, and the settings of every relay asked about are then fetched in one
+# batched pass (CHUNK_SIZE requests per query) instead of walking each
+# relay's requests.
+#
+# The index and settings can come from the Aspen database or from a
+# settings_store.SettingsStore snapshot.
+#
+# Example:
+#   history = settings_history.SettingsHistory.from_session(session)
+#   history.request_as_of(10001, datetime.date(2012, 6, 1))
+#   settings = history.settings_as_of(datetime.date(2012, 6, 1),
+#                                     locationid='MOORE')
+#   settings[10001][('GROUP1', 'Z1MP')]
+#
+#   python settings_history.py 2012-06-01 --location MOORE --setting Z1MP
+#   python settings_history.py 2012-06-01 --store output/settings_store.bin
+from __future__ import print_function
+
+import argparse
+import bisect
+import datetime
+import os
+import sys
+from collections import OrderedDict
+
+import aspendb
+import current_settings
+import sqlutil
+from aspendb import Relay, Request, Setting, SettingInfo
+
+# Request statuses of settings that were put in service
+IN_EFFECT_STATUSES = ('IN SERVICE', 'HISTORICAL')
+
+
+def _relay_id(relayid):
+    """ TREQUEST.relayid is a string column; use the integer TRELAY.id. """
+    try:
+        return int(relayid)
+    except (TypeError, ValueError):
+        return relayid
+
+
+def _date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+class SettingsHistory(object):
+    def __init__(self):
+        self.starts = {}  # relay id -> sorted list of service dates
+        self.requests = {}  # relay id -> request ids in the same order
+        self.locations = {}  # relay id -> location id
+        self.session = None
+        self.store = None
+
+    def _build(self, rows, statuses):
+        """ Index rows of (relay id, location id, request id, status,
+            service date, request date).
+        """
+        intervals = {}
+        for relayid, locationid, requestid, status, service_date, \
+                request_date in rows:
+            if service_date is None or \
+                    (statuses is not None and status not in statuses):
+                continue
+            relayid = _relay_id(relayid)
+            self.locations[relayid] = locationid
+            intervals.setdefault(relayid, []).append(
+                (_date(service_date), _date(request_date) or
+                 datetime.date.min, requestid))
+        for relayid, items in intervals.items():
+            items.sort()
+            self.starts[relayid] = [i[0] for i in items]
+            self.requests[relayid] = [i[2] for i in items]
+
+    @classmethod
+    def from_session(cls, session, statuses=IN_EFFECT_STATUSES):
+        """ Build the index from the Aspen database with one query. Only
+            requests with one of statuses are indexed (None for every
+            request with a service date).
+        """
+        history = cls()
+        history.session = session
+        history._build(session.query(Request.relayid, Relay.locationid,
+                                     Request.id, Request.status,
+                                     Request.service_date,
+                                     Request.request_date)
+                       .outerjoin(Request.relay), statuses)
+        return history
+
+    @classmethod
+    def from_store(cls, store, statuses=IN_EFFECT_STATUSES):
+        """ Build the index from a settings_store.SettingsStore snapshot. """
+        history = cls()
+        history.store = store
+        relays = store['Relay']
+        locations = dict(zip(relays['id'].values,
+                             (relays['locationid'][n]
+                              for n in range(len(relays)))))
+        requests = store['Request']
+        relayid, requestid, status, service_date, request_date = \
+            [requests[c] for c in ('relayid', 'id', 'status', 'service_date',
+                                   'request_date')]
+        history._build(((relayid[n], locations.get(_relay_id(relayid[n])),
+                         requestid[n], status[n], service_date[n],
+                         request_date[n])
+                        for n in range(len(requests))), statuses)
+        return history
+
+    def intervals(self, relayid):
+        """ Return the list of (start, end, request id) of the settings in
+            effect for a relay; end is None for the current settings.
+        """
+        starts = self.starts.get(relayid, [])
+        ends = starts[1:] + [None]
+        return list(zip(starts, ends, self.requests.get(relayid, [])))
+
+    def request_as_of(self, relayid, date):
+        """ Return the id of the request in effect for a relay on date, or
+            None if none was in service yet.
+        """
+        starts = self.starts.get(relayid)
+        if not starts:
+            return None
+        n = bisect.bisect_right(starts, _date(date)) - 1
+        return None if n < 0 else self.requests[relayid][n]
+
+    def relay_ids(self, locationid=None):
+        """ Return the indexed relay ids, optionally at one location. """
+        return sorted(r for r in self.starts
+                      if locationid is None or
+                      self.locations.get(r) == locationid)
+
+    def as_of(self, date, relay_ids=None, locationid=None):
+        """ Return a dict of relay id: request id in effect on date for the
+            given relays, the relays at a location, or the whole fleet.
+            Relays with nothing in service yet are left out.
+        """
+        if relay_ids is None:
+            relay_ids = self.relay_ids(locationid)
+        rtn = {}
+        for relayid in relay_ids:
+            requestid = self.request_as_of(relayid, date)
+            if requestid is not None:
+                rtn[relayid] = requestid
+        return rtn
+
+    def settings_as_of(self, date, relay_ids=None, locationid=None):
+        """ Return a dict of relay id: {(groupname, settingname): setting} in
+            effect on date, as as_of(), fetching the settings of every relay
+            together.
+        """
+        requests = self.as_of(date, relay_ids, locationid)
+        settings = self.fetch_settings(requests.values())
+        return dict((relayid, settings.get(requestid, {}))
+                    for relayid, requestid in requests.items())
+
+    def fetch_settings(self, request_ids):
+        """ Return a dict of request id: {(groupname, settingname): setting}.
+            The same setting name can appear in several groups, so the group
+            is part of the key. Each request's settings are in group and row
+            number order.
+        """
+        request_ids = sorted(set(request_ids))
+        rtn = dict((requestid, OrderedDict()) for requestid in request_ids)
+        if self.store is not None:
+            self._store_settings(rtn)
+            return rtn
+        for chunk in sqlutil.chunks(request_ids,
+                                    current_settings.CHUNK_SIZE):
+            for requestid, groupname, settingname, setting in \
+                    self.session.query(Setting.requestid, Setting.groupname,
+                                       SettingInfo.settingname,
+                                       Setting.setting) \
+                    .outerjoin(Setting.settinginfo) \
+                    .filter(Setting.requestid.in_(chunk)) \
+                    .order_by(Setting.groupname, Setting.rownumber):
+                rtn[requestid][(groupname, settingname)] = setting
+        return rtn
+
+    def _store_settings(self, rtn):
+        info = self.store['SettingInfo']
+        names = dict(((info['relaytype'][n], info['groupname'][n],
+                       info['rownumber'][n]), info['settingname'][n])
+                     for n in range(len(info)))
+        settings = self.store['Setting']
+        columns = [settings[c] for c in ('relaytype', 'groupname',
+                                         'rownumber', 'setting')]
+        for requestid, values in rtn.items():
+            rows = sorted([c[n] for c in columns]
+                          for n in settings['requestid'].find(requestid))
+            for relaytype, groupname, rownumber, setting in rows:
+                values[(groupname, names.get((relaytype, groupname,
+                                              rownumber)))] = setting
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Print relay settings in effect on a date.')
+    parser.add_argument('date', help='YYYY-MM-DD')
+    parser.add_argument('--relay', type=int, action='append',
+                        help='relay id; may be repeated')
+    parser.add_argument('--location', help='Aspen location id')
+    parser.add_argument('--setting', action='append',
+                        help='setting name to print (default all); may be '
+                             'repeated')
+    parser.add_argument('--store', nargs='?',
+                        const=os.path.join('output', 'settings_store.bin'),
+                        help='read from a settings_store snapshot instead of '
+                             'the Aspen database')
+    args = parser.parse_args(argv)
+
+    date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    if args.store:
+        import settings_store
+        history = SettingsHistory.from_store(
+            settings_store.SettingsStore(args.store))
+    else:
+        history = SettingsHistory.from_session(aspendb.get_orm_session())
+    requests = history.as_of(date, args.relay, args.location)
+    settings = history.settings_as_of(date, sorted(requests))
+    for relayid in sorted(settings):
+        print('Relay %s, request %s' % (relayid, requests[relayid]))
+        for (group, name), value in settings[relayid].items():
+            if args.setting is None or name in args.setting:
+                print('    %s %s := %s' % (group, name, value))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+# Typed numeric index over relay setting values.
+#
+# TSETTING1.setting is free text. This parses every numeric setting of the
+# in-service requests once and keeps, per (settingname, relaytype), the values
+# in a sorted array('d') with a parallel list of (requestid, groupname,
+# rownumber) references, so threshold audits are binary searches instead of
+# fleet-wide string scans.
+#
+# Numbers embedded in logic settings as "NAME := value" (such as the SEL DTT
+# timer pickup delays "AST01PT := 1.50" in the AUTO settings) are indexed too,
+# under NAME.
+#
+# Example:
+#   session = aspendb.get_orm_session()
+#   index = settings_index.SettingsIndex.from_session(session)
+#   index.save()
+#   ...
+#   index = settings_index.SettingsIndex.load()
+#   for value, (requestid, groupname, rownumber), relaytype in \
+#           index.range('AST01PT', low=1.0, include_low=False):
+#       print(index.relays[requestid], value)
+#   index.top('50P1P', 10, relaytype='SEL-421%')
+from __future__ import print_function
+
+import argparse
+import bisect
+import heapq
+import os
+import pickle
+import re
+import sys
+import time
+from array import array
+
+import aspendb
+import current_settings
+import sqlutil
+
+DEFAULT_PATH = os.path.join('output', 'settings_index.pickle')
+# Version of the saved index format
+VERSION = 1
+
+NUMBER = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+number = re.compile(NUMBER + '$')
+# Numeric assignment in a logic setting, e.g. 'AST01PT := 1.50'
+assignment = re.compile(r'([A-Z][A-Z0-9_]*) *:= *(' + NUMBER + ') *$')
+
+
+def parse_setting(settingname, setting):
+    """ Return a list of (settingname, float value) found in a setting: the
+        value itself if it is a number, or the target and value of a numeric
+        assignment. Returns an empty list for anything else.
+    """
+    if setting is None:
+        return []
+    setting = setting.strip()
+    if number.match(setting):
+        return [(settingname, float(setting))]
+    m = assignment.match(setting)
+    if m:
+        return [(m.group(1), float(m.group(2)))]
+    return []
+
+
+class NumericColumn(object):
+    """ Sorted values of one setting for one relay type with the reference
+        to the setting row of each value.
+    """
+    __slots__ = ('values', 'refs')
+
+    def __init__(self, pairs):
+        pairs.sort(key=lambda p: p[0])
+        self.values = array('d', [p[0] for p in pairs])
+        self.refs = [p[1] for p in pairs]
+
+    @classmethod
+    def from_sorted(cls, values, refs):
+        """ Return a column of already sorted values and their references. """
+        column = cls.__new__(cls)
+        column.values = values
+        column.refs = refs
+        return column
+
+    def __len__(self):
+        return len(self.values)
+
+    def slice(self, low=None, high=None, include_low=True, include_high=True):
+        """ Return (start, stop) of the values between low and high. """
+        if low is None:
+            start = 0
+        elif include_low:
+            start = bisect.bisect_left(self.values, low)
+        else:
+            start = bisect.bisect_right(self.values, low)
+        if high is None:
+            stop = len(self.values)
+        elif include_high:
+            stop = bisect.bisect_right(self.values, high)
+        else:
+            stop = bisect.bisect_left(self.values, high)
+        return start, max(start, stop)
+
+
+class SettingsIndex(object):
+    def __init__(self):
+        self.columns = {}  # (settingname, relaytype) -> NumericColumn
+        self.relays = {}  # requestid -> relayid
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Build from rows in current_settings.COLUMNS order. """
+        index = cls()
+        pairs = {}
+        for (relayid, locationid, relaytype, requestid, request_date,
+             groupname, rownumber, settingname, setting) in rows:
+            index.relays[requestid] = relayid
+            for name, value in parse_setting(settingname, setting):
+                pairs.setdefault((name, relaytype), []).append(
+                    (value, (requestid, groupname, rownumber)))
+        for key, key_pairs in pairs.items():
+            index.columns[key] = NumericColumn(key_pairs)
+        return index
+
+    @classmethod
+    def from_session(cls, session):
+        """ Build from the in-service settings in the Aspen database. """
+        return cls.from_rows(aspendb.current_settings_query(session)
+                             .yield_per(10000))
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build from a current_settings.CurrentSettings cache. """
+        return cls.from_rows(cache.query())
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """ Load an index written by save(). """
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            raise ValueError('%s is not a version %d settings index'
+                             % (path, VERSION))
+        index = cls()
+        index.columns = dict((key, NumericColumn.from_sorted(values, refs))
+                             for key, (values, refs)
+                             in data['columns'].items())
+        index.relays = data['relays']
+        return index
+
+    def save(self, path=DEFAULT_PATH):
+        """ Save the index as plain data (no classes of this module), so it
+            loads wherever it was written from.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        data = {'version': VERSION,
+                'columns': dict((key, (c.values, c.refs))
+                                for key, c in self.columns.items()),
+                'relays': self.relays}
+        with open(path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    def __len__(self):
+        return sum(len(c) for c in self.columns.values())
+
+    def settingnames(self):
+        return sorted(set(k[0] for k in self.columns))
+
+    def relaytypes(self, settingname):
+        return sorted(k[1] for k in self.columns if k[0] == settingname)
+
+    def _columns(self, settingname, relaytype):
+        """ Return (relay type, column) of settingname for the relay types
+            matching the LIKE pattern relaytype, or all if it is None.
+        """
+        if relaytype is not None and not sqlutil.is_pattern(relaytype):
+            column = self.columns.get((settingname, relaytype))
+            if column is not None:
+                return [(relaytype, column)]
+        match = None if relaytype is None else sqlutil.like(relaytype)
+        return [(k[1], c) for k, c in self.columns.items()
+                if k[0] == settingname and (match is None or match(k[1]))]
+
+    def range(self, settingname, low=None, high=None, relaytype=None,
+              include_low=True, include_high=True):
+        """ Return a list of (value, (requestid, groupname, rownumber),
+            relaytype) for settingname values between low and high, in
+            ascending value order. Bounds of None are open. relaytype
+            restricts the search to the relay types matching a SQL LIKE
+            pattern, e.g. 'SEL-421%'.
+        """
+        rtn = []
+        for rt, column in self._columns(settingname, relaytype):
+            start, stop = column.slice(low, high, include_low, include_high)
+            rtn.extend(zip(column.values[start:stop], column.refs[start:stop],
+                           [rt] * (stop - start)))
+        rtn.sort(key=lambda r: r[0])
+        return rtn
+
+    def count(self, settingname, low=None, high=None, relaytype=None,
+              include_low=True, include_high=True):
+        """ Return the number of values range() would return. """
+        rtn = 0
+        for rt, column in self._columns(settingname, relaytype):
+            start, stop = column.slice(low, high, include_low, include_high)
+            rtn += stop - start
+        return rtn
+
+    def top(self, settingname, k, relaytype=None, largest=True, low=None,
+            high=None, include_low=True, include_high=True):
+        """ Return the k largest (or smallest) values of settingname between
+            low and high as range() does, largest first when largest is set.
+        """
+        streams = []
+        for rt, column in self._columns(settingname, relaytype):
+            start, stop = column.slice(low, high, include_low, include_high)
+            if largest:
+                idx = range(stop - 1, max(stop - k, start) - 1, -1)
+            else:
+                idx = range(start, min(start + k, stop))
+            streams.append([(column.values[i], column.refs[i], rt)
+                            for i in idx])
+        # Merge on (sort value, stream, position) so references never compare
+        sign = -1 if largest else 1
+        merged = heapq.merge(*[[(sign * r[0], m, n, r)
+                                for n, r in enumerate(s)]
+                               for m, s in enumerate(streams)])
+        rtn = []
+        for value, m, n, r in merged:
+            if len(rtn) >= k:
+                break
+            rtn.append(r)
+        return rtn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build the numeric settings index, or query it.')
+    parser.add_argument('--path', default=DEFAULT_PATH)
+    parser.add_argument('--cache', nargs='?',
+                        const=current_settings.DEFAULT_PATH,
+                        help='build from the current settings cache instead '
+                             'of the Aspen database')
+    parser.add_argument('--setting', help='query values of this setting '
+                                          'from an existing index')
+    parser.add_argument('--relaytype', help='relay type (LIKE pattern)')
+    parser.add_argument('--min', type=float)
+    parser.add_argument('--max', type=float)
+    parser.add_argument('--top', type=int,
+                        help='show only the largest TOP values')
+    args = parser.parse_args(argv)
+
+    if args.setting is None:
+        start = time.time()
+        if args.cache:
+            cache = current_settings.CurrentSettings(args.cache)
+            index = SettingsIndex.from_cache(cache)
+            cache.close()
+        else:
+            index = SettingsIndex.from_session(aspendb.get_orm_session())
+        index.save(args.path)
+        print('Indexed %d values of %d settings in %.1f s'
+              % (len(index), len(index.columns), time.time() - start))
+        return
+
+    index = SettingsIndex.load(args.path)
+    if args.top:
+        rows = index.top(args.setting, args.top, args.relaytype,
+                         low=args.min, high=args.max)
+    else:
+        rows = index.range(args.setting, args.min, args.max, args.relaytype)
+    for value, (requestid, groupname, rownumber), relaytype in rows:
+        print('%g\t%s\t%s\t%s\t%s\t%g' % (value, relaytype,
+                                          index.relays.get(requestid),
+                                          requestid, groupname, rownumber))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,353 @@
+# Read-only, memory-mapped copy of the Aspen entities for multi-process
+# analysis (Python 3 only).
+#
+# write_store() dumps Location, Relay, Request, Setting, SettingInfo and the
+# RTU equivalents to one file of fixed-width columns: int64 for integers,
+# dates and datetimes, float64 for floats, and int32 codes into a sorted
+# per-column string table for text. SettingsStore maps the file read-only and
+# reads values straight out of the page cache, so any number of worker
+# processes opening the same file share one copy of it and nothing is
+# deserialized at startup.
+#
+# Nulls are INT_NULL for integer, date and datetime columns, NaN for floats
+# and code -1 for strings; they read back as None.
+#
+# Example:
+#   settings_store.write_store(aspendb.get_orm_session())
+#
+#   def work(relay_ids):            # in each worker process
+#       store = settings_store.SettingsStore()
+#       settings = store['Setting']
+#       for n in settings.find(requestid=100123):
+#           print(settings.row(n))
+from __future__ import print_function
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import OrderedDict
+
+from sqlalchemy import Integer, Float, Date, DateTime
+
+import aspendb
+
+DEFAULT_PATH = os.path.join('output', 'settings_store.bin')
+
+MAGIC = b'ASPNSTO1'
+VERSION = 1
+# Header: magic, directory offset, directory length
+HEADER = struct.Struct('<8sQQ')
+INT_NULL = -2 ** 63
+EPOCH = datetime.datetime(1970, 1, 1)
+
+ENTITIES = (aspendb.Location, aspendb.Relay, aspendb.Request,
+            aspendb.Setting, aspendb.SettingInfo, aspendb.RTU_Equipment,
+            aspendb.RTURequest, aspendb.RTUSetting, aspendb.RTUSettingInfo)
+
+
+def _kind(column):
+    if isinstance(column.type, Integer):
+        return 'i'
+    if isinstance(column.type, Float):
+        return 'd'
+    if isinstance(column.type, DateTime):
+        return 'datetime'
+    if isinstance(column.type, Date):
+        return 'date'
+    return 's'
+
+
+def _encode(kind, value):
+    """ Return the stored number for a value of a non-string column. The
+        driver may return floats or Decimals for integer columns, so values
+        are converted to the column's type.
+    """
+    if kind == 'd':
+        return float('nan') if value is None else float(value)
+    if value is None:
+        return INT_NULL
+    if kind == 'date':
+        return value.toordinal()
+    if kind == 'datetime':
+        return (value - EPOCH) // datetime.timedelta(microseconds=1)
+    return int(value)
+
+
+class _ColumnWriter(object):
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        if kind == 's':
+            self.values = array('i')
+            self.strings = {}
+        else:
+            self.values = array('d' if kind == 'd' else 'q')
+
+    def append(self, value):
+        if self.kind != 's':
+            self.values.append(_encode(self.kind, value))
+        elif value is None:
+            self.values.append(-1)
+        else:
+            # String-mapped columns such as TREQUEST.relayid can come back
+            # as numbers
+            value = str(value)
+            try:
+                code = self.strings[value]
+            except KeyError:
+                code = self.strings[value] = len(self.strings)
+            self.values.append(code)
+
+    def blocks(self):
+        """ Return the column description and a list of (key, bytes) blocks
+            to store.
+        """
+        desc = {'name': self.name, 'kind': self.kind}
+        if self.kind != 's':
+            values = self.values
+            desc['sorted'] = self.kind == 'i' and all(
+                values[n] <= values[n + 1] for n in range(len(values) - 1))
+            return desc, [('values', values.tobytes())]
+        # Renumber codes so the string table is sorted and can be searched
+        strings = sorted(self.strings)
+        mapping = array('i', [0] * len(strings))
+        for code, s in enumerate(strings):
+            mapping[self.strings[s]] = code
+        codes = array('i', [-1 if c < 0 else mapping[c] for c in self.values])
+        offsets = array('q', [0])
+        data = []
+        for s in strings:
+            encoded = s.encode('utf-8')
+            data.append(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+        return desc, [('codes', codes.tobytes()),
+                      ('offsets', offsets.tobytes()),
+                      ('data', b''.join(data))]
+
+
+def write_store(session, path=DEFAULT_PATH, entities=ENTITIES):
+    """ Write every row of each entity to a store file at path, in primary
+        key order. Returns the directory written.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tables = OrderedDict()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for entity in entities:
+            attrs = [p for p in entity.__mapper__.column_attrs
+                     if len(p.columns) == 1]
+            writers = [_ColumnWriter(p.key, _kind(p.columns[0]))
+                       for p in attrs]
+            query = session.query(*[getattr(entity, p.key) for p in attrs]) \
+                .order_by(*entity.__mapper__.primary_key)
+            rows = 0
+            for row in query.yield_per(10000):
+                rows += 1
+                for w, value in zip(writers, row):
+                    w.append(value)
+            columns = []
+            for w in writers:
+                desc, blocks = w.blocks()
+                for key, data in blocks:
+                    f.write(b'\0' * (-f.tell() % 8))
+                    desc[key] = [f.tell(), len(data)]
+                    f.write(data)
+                columns.append(desc)
+            tables[entity.__name__] = {'table': entity.__tablename__,
+                                       'rows': rows, 'columns': columns}
+        index = json.dumps({'version': VERSION,
+                            'tables': tables}).encode('utf-8')
+        offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, offset, len(index)))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return tables
+
+
+class StoreColumn(object):
+    """ One column of a store table. Indexing returns decoded values;
+        values (or codes for strings) is the underlying memoryview.
+    """
+    def __init__(self, store, desc):
+        self.name = desc['name']
+        self.kind = desc['kind']
+        self.sorted = desc.get('sorted', False)
+        if self.kind == 's':
+            self.codes = store._view(desc['codes'], 'i')
+            self.offsets = store._view(desc['offsets'], 'q')
+            self.data = store._view(desc['data'])
+            self.values = self.codes
+        else:
+            self.values = store._view(desc['values'],
+                                      'd' if self.kind == 'd' else 'q')
+
+    def __len__(self):
+        return len(self.values)
+
+    def string(self, code):
+        """ Return string number code of the string table. """
+        return str(self.data[self.offsets[code]:self.offsets[code + 1]],
+                   'utf-8')
+
+    def __getitem__(self, n):
+        value = self.values[n]
+        if self.kind == 's':
+            return None if value < 0 else self.string(value)
+        if self.kind == 'd':
+            return None if math.isnan(value) else value
+        if value == INT_NULL:
+            return None
+        if self.kind == 'date':
+            return datetime.date.fromordinal(value)
+        if self.kind == 'datetime':
+            return EPOCH + datetime.timedelta(microseconds=value)
+        return value
+
+    def encode(self, value):
+        """ Return the stored form of value, or None if a string value is not
+            in the string table.
+        """
+        if self.kind != 's':
+            return _encode(self.kind, value)
+        if value is None:
+            return -1
+        value = str(value)
+        lo, hi = 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.offsets) - 1 and self.string(lo) == value:
+            return lo
+        return None
+
+    def find(self, value):
+        """ Return the list of row numbers where the column equals value.
+            Sorted integer columns (such as leading primary keys) are
+            searched by bisection, others scanned.
+        """
+        encoded = self.encode(value)
+        if encoded is None:
+            return []
+        if self.sorted:
+            return list(range(bisect.bisect_left(self.values, encoded),
+                              bisect.bisect_right(self.values, encoded)))
+        values = self.values
+        return [n for n in range(len(values)) if values[n] == encoded]
+
+
+class StoreTable(object):
+    def __init__(self, store, name, desc):
+        self.name = name
+        self.table = desc['table']
+        self.rows = desc['rows']
+        self.columns = OrderedDict((c['name'], StoreColumn(store, c))
+                                   for c in desc['columns'])
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def row(self, n):
+        """ Return row n as a dict of column name: value. """
+        return dict((name, c[n]) for name, c in self.columns.items())
+
+    def find(self, **criteria):
+        """ Return the row numbers matching all column=value criteria,
+            using the sorted columns first.
+        """
+        items = sorted(criteria.items(),
+                       key=lambda i: not self.columns[i[0]].sorted)
+        rows = None
+        for name, value in items:
+            column = self.columns[name]
+            if rows is None:
+                rows = column.find(value)
+                continue
+            encoded = column.encode(value)
+            rows = [n for n in rows if column.values[n] == encoded]
+        return rows if rows is not None else list(range(self.rows))
+
+
+class SettingsStore(object):
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mmap)
+        self.views = []
+        magic, offset, length = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError('%s is not a settings store' % path)
+        directory = json.loads(str(self.buf[offset:offset + length],
+                                   'utf-8'))
+        if directory['version'] != VERSION:
+            raise ValueError('%s is store version %s, not %s'
+                             % (path, directory['version'], VERSION))
+        self.tables = OrderedDict((name, StoreTable(self, name, desc))
+                                  for name, desc
+                                  in directory['tables'].items())
+
+    def _view(self, block, fmt=None):
+        offset, length = block
+        view = self.buf[offset:offset + length]
+        if fmt is not None:
+            view = view.cast(fmt)
+        self.views.append(view)
+        return view
+
+    def __getitem__(self, name):
+        """ Return the StoreTable of an entity, e.g. store['Setting']. """
+        return self.tables[name]
+
+    def close(self):
+        self.tables = None
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.buf.release()
+        self.mmap.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write the memory-mapped store of the Aspen entities.')
+    parser.add_argument('--path', default=DEFAULT_PATH)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    tables = write_store(aspendb.get_orm_session(), args.path)
+    for name, desc in tables.items():
+        print('%-16s %10d rows' % (name, desc['rows']))
+    print('Wrote %s, %d bytes in %.1f s' % (args.path,
+                                            os.path.getsize(args.path),
+                                            time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# Small helpers shared by the modules that query the Aspen and SAP databases
+# or filter their results in memory.
+#
+# like() matches strings against a SQL LIKE pattern the way the Aspen (MSSQL)
+# database does: % for any run of characters, _ for any one character,
+# case-insensitively. Every other character, including * and ?, is literal.
+# Use it wherever a LIKE pattern argument is applied to data already in
+# memory, so it behaves the same as when it is passed to the database.
+#
+# chunks() splits a list into pieces, e.g. for IN lists of bounded size.
+#
+# Example:
+#   match = sqlutil.like('SEL-421%')
+#   match('SEL-421-4')                      True
+#   for chunk in sqlutil.chunks(relay_ids, 500):
+#       query.filter(Relay.id.in_(chunk))
+import re
+
+
+def like(pattern):
+    """ Return a function matching strings against a SQL LIKE pattern. The
+        function returns False for None.
+    """
+    regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c)
+                    for c in pattern)
+    match = re.compile(regex + r'\Z', re.IGNORECASE | re.DOTALL).match
+    return lambda s: s is not None and match(s) is not None
+
+
+def is_pattern(pattern):
+    """ Return True if pattern has LIKE wildcards. """
+    return '%' in pattern or '_' in pattern
+
+
+def chunks(items, size):
+    """ Yield successive slices of at most size items of a list. """
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
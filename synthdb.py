@@ -0,0 +1,390 @@
+# Synthetic Aspen and SAP equipment databases for local testing and
+# benchmarking.
+#
+# Builds SQLite databases with the same tables and columns as the aspendb and
+# eqdb models (TLOCATION, TRELAY, TREQUEST, TSETTING1, TSETTYPE1, the
+# TUSERDEF2 family and the SAP equipment views) filled with repeatable
+# pseudo-random data. The Aspen and SAP sides share equipment numbers,
+# district numbers and functional locations, with a small fraction of
+# deliberate mismatches so the compare report has something to find.
+#
+# Example:
+#   python synthdb.py --substations 50 --relays 12 output/synth
+#
+# Point the libraries at the result with
+#   aspendb.engine_url = 'sqlite:///output/synth/aspen.sqlite'
+#   eqdb.engine_url = 'sqlite:///output/synth/sap.sqlite'
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import random
+import sys
+
+import sqlalchemy
+
+import aspendb
+import eqdb
+
+# Location names used before falling back to generated ones. MOORE and
+# ANTELOPE are used by the existing example scripts.
+LOCATION_NAMES = ['MOORE', 'ANTELOPE', 'SHELDON', 'COLUMBUS', 'HOLDREGE',
+                  'KEARNEY', 'AXTELL', 'GENTLEMAN', 'BEATRICE', 'HOSKINS',
+                  'MAXWELL', 'STEGALL', 'SWEETWATER', 'THEDFORD', 'CANADAY',
+                  'MULLEN', 'OGALLALA', 'PAULINE', 'ROCKCREEK', 'SIDNEY']
+AREAS = ['Northern', 'Eastern', 'Central', 'Western']
+AREA_CODES = {'Northern': 'N', 'Eastern': 'E', 'Central': 'C',
+              'Western': 'W'}
+VOLTAGES = ['345', '230', '115']
+
+RELAY_TYPES = ['SEL-421-4', 'SEL-311C', 'SEL-351S', 'SEL-487E', 'SEL-311L']
+RTU_TYPES = ['SEL-2032', 'SEL-3530', 'D20ME']
+FUNCTIONS = ['PRIMARY', 'BACKUP', 'BREAKER FAILURE', 'BUS DIFF']
+
+# Fraction of equipment with deliberate Aspen/SAP inconsistencies
+MISMATCH_FRACTION = 0.05
+MISSING_FRACTION = 0.03
+
+
+def _row(cls, **attrs):
+    """ Convert ORM attribute names to column names for a Core insert. """
+    columns = cls.__mapper__.columns
+    return dict((columns[k].name, v) for k, v in attrs.items())
+
+
+def _insert(conn, cls, rows):
+    if rows:
+        conn.execute(cls.__table__.insert(), rows)
+
+
+def location_names(count):
+    names = LOCATION_NAMES[:count]
+    n = 0
+    while len(names) < count:
+        n += 1
+        names.append('%s%d' % (LOCATION_NAMES[n % len(LOCATION_NAMES)], n))
+    return names
+
+
+def setting_names(relaytype, count):
+    """ Return a list of (groupname, settingname) for a relay type.
+
+        The first rows are the ones looked at by the example reports (RID,
+        TID, OUT101 RB, OUT103 RI, DTT alarm outputs and the AST timer
+        AUTO settings), followed by numbered element settings to reach the
+        requested count.
+    """
+    names = [('HRDWR', 'RID'), ('HRDWR', 'TID'), ('HRDWR', 'CTRW'),
+             ('HRDWR', 'PTRY'),
+             ('OUTPUT', 'OUT101'), ('OUTPUT', 'OUT102'),
+             ('OUTPUT', 'OUT103'), ('OUTPUT', 'OUT104'),
+             ('LOGIC1', 'AUTO_1'), ('LOGIC1', 'AUTO_2'),
+             ('GROUP1', 'Z1MP'), ('GROUP1', 'Z2MP'), ('GROUP1', 'Z2PD'),
+             ('GROUP1', '50P1P'), ('GROUP1', '51SP'), ('GROUP1', '67QTC'),
+             ('GROUP1', 'TDURD')]
+    n = 0
+    while len(names) < count:
+        n += 1
+        group = 'GROUP%d' % (1 + (n // 200))
+        names.append((group, 'E%s%d' % (('50P', '51G', '21P', '67G')[n % 4],
+                                        n)))
+    return names[:count]
+
+
+def setting_value(rnd, relay, settingname, timer):
+    """ Return a plausible SEL setting string for a setting name. """
+    if settingname == 'RID':
+        return relay['device_num']
+    if settingname == 'TID':
+        return relay['protecting']
+    if settingname == 'CTRW':
+        return '%d' % rnd.choice((120, 240, 400, 600))
+    if settingname == 'PTRY':
+        return '%d' % rnd.choice((1200, 2000, 3000))
+    if settingname == 'OUT101':
+        return 'RB%02d * TRIP' % rnd.randint(1, 8)
+    if settingname == 'OUT103':
+        return '67P1T + Z1T + RI%02d' % rnd.randint(1, 8)
+    if settingname in ('OUT102', 'OUT104'):
+        if timer is not None:
+            kind = 'FAIL' if settingname == 'OUT102' else 'ALARM'
+            return '%sQ #DTT CH%d RX %s' % (timer, rnd.randint(1, 2), kind)
+        return 'IN10%d' % rnd.randint(1, 8)
+    if settingname == 'AUTO_2':
+        return 'SV01 := IN101 * IN102'
+    if settingname.startswith('AUTO'):
+        if timer is not None:
+            return '%sPT := %.2f' % (timer, rnd.choice((0.5, 1.0, 1.5, 2.0,
+                                                        2.0, 2.0, 30.0)))
+        return 'NA'
+    if settingname in ('Z1MP', 'Z2MP'):
+        return '%.2f' % rnd.uniform(0.5, 40.0)
+    if settingname in ('Z2PD', 'TDURD'):
+        return '%.2f' % rnd.choice((9.0, 12.0, 18.0, 20.0, 30.0))
+    if settingname in ('50P1P', '51SP'):
+        return '%.2f' % rnd.uniform(0.5, 20.0)
+    if settingname == '67QTC':
+        return rnd.choice(('1', '32QF', 'NA'))
+    return rnd.choice(('%.2f' % rnd.uniform(0.1, 100.0), 'OFF', 'Y', 'N',
+                       '%d' % rnd.randint(1, 60)))
+
+
+def build_aspen(engine, substations=20, relays_per_station=10,
+                requests_per_relay=3, settings_per_request=200,
+                rtu_per_station=2, seed=0):
+    """ Create the Aspen tables on engine and fill them with synthetic data.
+        Returns the location, relay and RTU dicts (ORM attribute names) so
+        the SAP database can be built to match.
+    """
+    rnd = random.Random(seed)
+    aspendb.Base.metadata.create_all(engine)
+
+    setting_info = dict((t, setting_names(t, settings_per_request))
+                        for t in RELAY_TYPES + RTU_TYPES)
+
+    locations = []
+    relays = []
+    rtus = []
+    relay_id = 10000
+    rtu_id = 50000
+    eq_num = 10000000
+    for n, name in enumerate(location_names(substations)):
+        area = AREAS[n % len(AREAS)]
+        sub_num = '9%05d' % n
+        voltage = rnd.choice(VOLTAGES)
+        sap_fl = '-'.join(('TS', 'S', AREA_CODES[area], sub_num))
+        locations.append({'id': name,
+                          'name': '%s %s' % (name, sub_num),
+                          'area': area,
+                          'region': area,
+                          'voltage': voltage,
+                          'sap_fl': sap_fl})
+        for r in range(relays_per_station):
+            relay_id += 1
+            eq_num += 1
+            other = rnd.choice(LOCATION_NAMES)
+            relays.append({
+                'id': relay_id,
+                'locationid': name,
+                'relaytype': rnd.choice(RELAY_TYPES),
+                'protecting': '%s - %s %sKV LINE' % (name, other, voltage),
+                'district_num': '%06d' % (eq_num % 1000000),
+                'sap_eq_num': eq_num,
+                'device_num': '%d%02d' % (rnd.choice((21, 50, 67, 87)), r),
+                'function': rnd.choice(FUNCTIONS),
+                'style_num': '0421%06X' % rnd.getrandbits(24),
+                'serial_num': '%010d' % rnd.getrandbits(32),
+                'owner': 'NPPD',
+                'functional_location': '%s-P%02d' % (sap_fl, r // 4 + 1),
+                'memo': None})
+        for r in range(rtu_per_station):
+            rtu_id += 1
+            eq_num += 1
+            rtus.append({
+                'id': rtu_id,
+                'locationid': name,
+                'relaytype': rnd.choice(RTU_TYPES),
+                'protecting': 'SCADA',
+                'district_num': '%06d' % (eq_num % 1000000),
+                'sap_eq_num': eq_num,
+                'device_num': 'RTU%d' % r,
+                'function': 'SCADA',
+                'style_num': '2032%06X' % rnd.getrandbits(24),
+                'serial_num': '%010d' % rnd.getrandbits(32),
+                'owner': 'NPPD',
+                'functional_location': '%s-C01' % sap_fl})
+
+    with engine.begin() as conn:
+        _insert(conn, aspendb.Location,
+                [_row(aspendb.Location, **l) for l in locations])
+        _insert(conn, aspendb.Relay,
+                [_row(aspendb.Relay, **r) for r in relays])
+        _insert(conn, aspendb.RTU_Equipment,
+                [_row(aspendb.RTU_Equipment, **r) for r in rtus])
+        _insert(conn, aspendb.SettingInfo,
+                [_row(aspendb.SettingInfo, relaytype=t, groupname=g,
+                      rownumber=float(n), settingname=s, range='',
+                      defaultvalue='', comments='')
+                 for t in RELAY_TYPES
+                 for n, (g, s) in enumerate(setting_info[t])])
+        _insert(conn, aspendb.RTUSettingInfo,
+                [_row(aspendb.RTUSettingInfo, devicetype=t,
+                      userdef_table='TUSERDEF2', groupname=g,
+                      rownumber=float(n), settingname=s, range='',
+                      defaultvalue='', comments='')
+                 for t in RTU_TYPES
+                 for n, (g, s) in enumerate(setting_info[t])])
+
+        request_id = 100000
+        for kind, devices in (('relay', relays), ('rtu', rtus)):
+            for device in devices:
+                # Roughly a third of the relays carry a DTT receive timer
+                timer = 'AST%02d' % rnd.randint(1, 9) \
+                    if kind == 'relay' and rnd.random() < 0.35 else None
+                date = datetime.date(2000, 1, 1) + \
+                    datetime.timedelta(days=rnd.randint(0, 2000))
+                requests = []
+                settings = []
+                for q in range(requests_per_relay):
+                    request_id += 1
+                    date += datetime.timedelta(days=rnd.randint(60, 1500))
+                    if q == requests_per_relay - 1:
+                        status = 'IN SERVICE'
+                    else:
+                        status = 'HISTORICAL'
+                    request = {'id': request_id,
+                               'requestor': 'SYNTH',
+                               'setting_type': 'RELAY SETTINGS',
+                               'status': status,
+                               'request_date': date,
+                               'service_date': date +
+                               datetime.timedelta(days=rnd.randint(1, 90)),
+                               'sign': None,
+                               'dlastsigned': None,
+                               'dlastchanged': datetime.datetime.combine(
+                                   date, datetime.time(12, 0))}
+                    if kind == 'relay':
+                        request['relayid'] = device['id']
+                        requests.append(_row(aspendb.Request, **request))
+                    else:
+                        request['deviceid'] = device['id']
+                        requests.append(_row(aspendb.RTURequest, **request))
+                    for n, (g, s) in enumerate(
+                            setting_info[device['relaytype']]):
+                        value = setting_value(rnd, device, s, timer)
+                        if kind == 'relay':
+                            settings.append(_row(
+                                aspendb.Setting, requestid=request_id,
+                                relaytype=device['relaytype'], groupname=g,
+                                rownumber=float(n), setting=value, range='',
+                                comments=''))
+                        else:
+                            settings.append(_row(
+                                aspendb.RTUSetting, requestid=request_id,
+                                devicetype=device['relaytype'],
+                                userdef_table='TUSERDEF2', groupname=g,
+                                rownumber=float(n), setting=value, range='',
+                                comments=''))
+                if kind == 'relay':
+                    _insert(conn, aspendb.Request, requests)
+                    _insert(conn, aspendb.Setting, settings)
+                else:
+                    _insert(conn, aspendb.RTURequest, requests)
+                    _insert(conn, aspendb.RTUSetting, settings)
+
+    return locations, relays, rtus
+
+
+def build_sap(engine, locations, relays, rtus, extra_per_station=3,
+              seed=0):
+    """ Create the SAP equipment tables on engine and fill them with rows
+        matching the Aspen devices, with a few mismatches and some equipment
+        that only exists in SAP.
+    """
+    rnd = random.Random(seed + 1)
+    eqdb.Base.metadata.create_all(engine)
+
+    relay_ids = set(r['id'] for r in relays)
+    rows = {}
+    for device in relays + rtus:
+        if rnd.random() < MISSING_FRACTION:
+            continue
+        row = {'sap_eq_num': device['sap_eq_num'],
+               'functional_location': device['functional_location'],
+               'functional_location_description': device['protecting'],
+               'manufacturer': 'SEL',
+               'model_number': device['style_num'],
+               'construction_year': rnd.randint(1995, 2017),
+               'serial_num': device['serial_num'],
+               'district_num': device['district_num'],
+               'owner_identification': device['owner']}
+        if rnd.random() < MISMATCH_FRACTION:
+            row['serial_num'] = '%010d' % rnd.getrandbits(32)
+        if rnd.random() < MISMATCH_FRACTION:
+            row['district_num'] = '%06d' % rnd.randint(0, 999999)
+        if device['id'] not in relay_ids:
+            cls = eqdb.Comm_Interface
+            row.update({'panel': 'C01',
+                        'firmware_1': 'R%d' % rnd.randint(100, 150)})
+        else:
+            cls = eqdb.Relay
+            row.update({'relay_type': device['relaytype'],
+                        'NPPD_device': device['device_num'],
+                        'relay_function': device['function'],
+                        'protecting': device['protecting'],
+                        'panel': device['functional_location'][-3:],
+                        'firmware': 'R%d' % rnd.randint(100, 150)})
+            if rnd.random() < MISMATCH_FRACTION:
+                row['NPPD_device'] = '%d' % rnd.randint(1, 99)
+        rows.setdefault(cls, []).append(_row(cls, **row))
+
+    eq_num = 20000000
+    extra_classes = [c for c in eqdb.SAPEquipment.all_subclasses()
+                     if c not in (eqdb.Relay, eqdb.Comm_Interface)]
+    for location in locations:
+        for n in range(extra_per_station):
+            eq_num += 1
+            cls = rnd.choice(extra_classes)
+            row = {'sap_eq_num': eq_num,
+                   'functional_location': '%s-C01' % location['sap_fl'],
+                   'manufacturer': 'SEL',
+                   'model_number': 'SEL-%d' % rnd.randint(2400, 2750),
+                   'construction_year': rnd.randint(1995, 2017),
+                   'serial_num': '%010d' % rnd.getrandbits(32),
+                   'district_num': '%06d' % (eq_num % 1000000)}
+            rows.setdefault(cls, []).append(_row(cls, **row))
+
+    with engine.begin() as conn:
+        for cls, cls_rows in rows.items():
+            _insert(conn, cls, cls_rows)
+
+
+def build(directory, substations=20, relays_per_station=10,
+          requests_per_relay=3, settings_per_request=200, seed=0):
+    """ Build aspen.sqlite and sap.sqlite in directory, replacing existing
+        files. Returns the SQLAlchemy URLs of the two databases.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    urls = []
+    for name in ('aspen.sqlite', 'sap.sqlite'):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            os.remove(path)
+        urls.append('sqlite:///' + os.path.abspath(path))
+    aspen_url, sap_url = urls
+
+    locations, relays, rtus = build_aspen(
+        sqlalchemy.create_engine(aspen_url), substations=substations,
+        relays_per_station=relays_per_station,
+        requests_per_relay=requests_per_relay,
+        settings_per_request=settings_per_request, seed=seed)
+    build_sap(sqlalchemy.create_engine(sap_url), locations, relays, rtus,
+              seed=seed)
+    return aspen_url, sap_url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build synthetic Aspen and SAP SQLite databases.')
+    parser.add_argument('directory')
+    parser.add_argument('--substations', type=int, default=20)
+    parser.add_argument('--relays', type=int, default=10,
+                        help='relays per substation')
+    parser.add_argument('--requests', type=int, default=3,
+                        help='setting requests per relay')
+    parser.add_argument('--settings', type=int, default=200,
+                        help='settings per request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for url in build(args.directory, substations=args.substations,
+                     relays_per_station=args.relays,
+                     requests_per_relay=args.requests,
+                     settings_per_request=args.settings, seed=args.seed):
+        print(url)
+
+
+if __name__ == '__main__':
+    sys.exit(main())